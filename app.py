@@ -1,24 +1,53 @@
+import time
+
+BOOT_STARTED = time.perf_counter()
+
 import os
 import sys
 import json
 import yaml
 import glob
+import copy
+import re
+import random
+import hashlib
+import pickle
+import sqlite3
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FuturesTimeout
 from datetime import datetime, timedelta
-from flask import Flask, request, jsonify, render_template
+from urllib.parse import parse_qsl
+from flask import Flask, Blueprint, Response, request, jsonify, render_template
 import threading
-import time
+import queue
+import atexit
+import asyncio
+import io
+import heapq
+import itertools
+import socket
+import bisect
+import gzip
+from contextlib import contextmanager
 import pytz
 
 from twilio.twiml.messaging_response import MessagingResponse
-from twilio.rest import Client
+from twilio.base.exceptions import TwilioRestException
+
+# twilio.rest, supabase, google.generativeai and jsonschema are imported
+# inside the functions that first need them; together they are most of
+# the import cost of a worker.
+
+startup_timings = {
+    'imports_ms': round((time.perf_counter() - BOOT_STARTED) * 1000, 1)
+}
+
 
-from supabase import create_client, Client as SupabaseClient
-import google.generativeai as genai
-from jsonschema import validate, ValidationError
+def record_startup_phase(name, started):
+    startup_timings[f"{name}_ms"] = round(
+        (time.perf_counter() - started) * 1000, 1)
 
-app = Flask(__name__)
-app.config['SECRET_KEY'] = os.environ.get(
-    'SESSION_SECRET', 'dev-secret-key-change-in-production')
 
 TWILIO_ACCOUNT_SID = os.environ.get('TWILIO_ACCOUNT_SID', '')
 TWILIO_AUTH_TOKEN = os.environ.get('TWILIO_AUTH_TOKEN', '')
@@ -26,57 +55,1144 @@ TWILIO_PHONE_NUMBER = os.environ.get('TWILIO_PHONE_NUMBER', '')
 GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY', '')
 SUPABASE_URL = os.environ.get('SUPABASE_URL', '')
 SUPABASE_SERVICE_ROLE_KEY = os.environ.get('SUPABASE_SERVICE_ROLE_KEY', '')
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'supabase').lower()
+DATABASE_URL = os.environ.get('DATABASE_URL', '')
+SQLITE_PATH = os.environ.get('SQLITE_PATH', 'data/neuvero.sqlite3')
+PG_POOL_MIN = int(os.environ.get('PG_POOL_MIN', '1'))
+PG_POOL_MAX = int(os.environ.get('PG_POOL_MAX', '10'))
+SESSION_CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE', '1000'))
+SESSION_CACHE_TTL = float(os.environ.get('SESSION_CACHE_TTL', '300'))
+ASYNC_REPLY_WORKERS = int(os.environ.get('ASYNC_REPLY_WORKERS', '4'))
+LLM_CACHE_PATH = os.environ.get('LLM_CACHE_PATH', 'data/llm_cache.sqlite3')
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', '10000'))
+LOG_BATCH_SIZE = int(os.environ.get('LOG_BATCH_SIZE', '50'))
+LOG_FLUSH_INTERVAL = float(os.environ.get('LOG_FLUSH_INTERVAL', '1.0'))
+LOG_QUEUE_POLICY = os.environ.get('LOG_QUEUE_POLICY', 'block')
+LOG_NODE_ID = os.environ.get('LOG_NODE_ID', '')
+SCHEDULER_WINDOW_MINUTES = float(os.environ.get('SCHEDULER_WINDOW_MINUTES', '10'))
+SCHEDULER_DISPATCH_WORKERS = int(os.environ.get('SCHEDULER_DISPATCH_WORKERS', '8'))
+TWILIO_MAX_MPS = float(os.environ.get('TWILIO_MAX_MPS', '1'))
+TWILIO_SEND_WORKERS = int(os.environ.get('TWILIO_SEND_WORKERS', '8'))
+TWILIO_SEND_RETRIES = int(os.environ.get('TWILIO_SEND_RETRIES', '3'))
+TWILIO_HTTP_TIMEOUT = float(os.environ.get('TWILIO_HTTP_TIMEOUT', '10'))
+SMS_TRANSLITERATE = os.environ.get('SMS_TRANSLITERATE', '1') != '0'
+SMS_STRIP_MARKDOWN = os.environ.get('SMS_STRIP_MARKDOWN', '1') != '0'
+SCHEDULER_ENABLED = os.environ.get('SCHEDULER_ENABLED', '1') != '0'
+SCHEDULER_LEASE_SECONDS = float(os.environ.get('SCHEDULER_LEASE_SECONDS', '300'))
+SCHEDULER_CLAIM_BATCH = int(os.environ.get('SCHEDULER_CLAIM_BATCH', '100'))
+FLOW_WATCH_INTERVAL = float(os.environ.get('FLOW_WATCH_INTERVAL', '0'))
+FLOW_CACHE_DIR = os.environ.get('FLOW_CACHE_DIR', 'data/.flow_cache')
+CLIENT_WARMUP = os.environ.get('CLIENT_WARMUP', '1') != '0'
+ASGI_MAX_IN_FLIGHT = int(os.environ.get('ASGI_MAX_IN_FLIGHT', '256'))
+PHONE_LOCK_SHARDS = int(os.environ.get('PHONE_LOCK_SHARDS', '1024'))
+PHONE_LOCK_TIMEOUT = float(os.environ.get('PHONE_LOCK_TIMEOUT', '20'))
+SESSION_MAX_RETRIES = int(os.environ.get('SESSION_MAX_RETRIES', '2'))
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') != '0'
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', '0'))
+HEALTH_CACHE_SECONDS = float(os.environ.get('HEALTH_CACHE_SECONDS', '5'))
+HEALTH_PROBE_TIMEOUT = float(os.environ.get('HEALTH_PROBE_TIMEOUT', '2'))
+HEALTH_STORAGE_MAX_MS = float(os.environ.get('HEALTH_STORAGE_MAX_MS', '1000'))
+HEALTH_LOG_QUEUE_MAX = float(os.environ.get('HEALTH_LOG_QUEUE_MAX', '0.9'))
+HEALTH_OVERDUE_GRACE_SECONDS = float(os.environ.get('HEALTH_OVERDUE_GRACE_SECONDS', '120'))
+HEALTH_MAX_OVERDUE_SECONDS = float(os.environ.get('HEALTH_MAX_OVERDUE_SECONDS', '900'))
+RESCORE_BATCH_SIZE = int(os.environ.get('RESCORE_BATCH_SIZE', '1000'))
+PAGE_CACHE_MAX_AGE = int(os.environ.get('PAGE_CACHE_MAX_AGE', '300'))
+INTAKE_QUEUE_SIZE = int(os.environ.get('INTAKE_QUEUE_SIZE', '5000'))
+INTAKE_BATCH_SIZE = int(os.environ.get('INTAKE_BATCH_SIZE', '100'))
+INTAKE_WORKERS = int(os.environ.get('INTAKE_WORKERS', '2'))
+INTAKE_DEDUPE_SECONDS = float(os.environ.get('INTAKE_DEDUPE_SECONDS', '600'))
 
 required_env_vars = {
     'TWILIO_ACCOUNT_SID': TWILIO_ACCOUNT_SID,
     'TWILIO_AUTH_TOKEN': TWILIO_AUTH_TOKEN,
     'TWILIO_PHONE_NUMBER': TWILIO_PHONE_NUMBER,
-    'GEMINI_API_KEY': GEMINI_API_KEY,
-    'SUPABASE_URL': SUPABASE_URL,
-    'SUPABASE_SERVICE_ROLE_KEY': SUPABASE_SERVICE_ROLE_KEY
+    'GEMINI_API_KEY': GEMINI_API_KEY
 }
+if STORAGE_BACKEND == 'supabase':
+    required_env_vars['SUPABASE_URL'] = SUPABASE_URL
+    required_env_vars['SUPABASE_SERVICE_ROLE_KEY'] = SUPABASE_SERVICE_ROLE_KEY
+elif STORAGE_BACKEND == 'postgres':
+    required_env_vars['DATABASE_URL'] = DATABASE_URL
 
 missing_vars = [k for k, v in required_env_vars.items() if not v]
 if missing_vars:
     error_msg = f"CRITICAL WARNING: Missing environment variables: {', '.join(missing_vars)}"
     print(error_msg, file=sys.stderr)
 
-supabase: SupabaseClient = None
-if SUPABASE_URL and SUPABASE_SERVICE_ROLE_KEY:
-    supabase = create_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """Prometheus-style histogram with fixed buckets, one series per label set.
+
+    `observe` is a bisect and a few additions under a lock, cheap enough to
+    stay on in production.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def observe(self, value, *label_values):
+        if not METRICS_ENABLED:
+            return
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                # bucket counts, +Inf overflow, then the running sum
+                series = self._series[label_values] = [0] * (
+                    len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def render(self):
+        with self._lock:
+            series = {k: list(v) for k, v in self._series.items()}
+        bucket_labels = self.labels + ('le', )
+        lines = []
+        for label_values, counts in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = format_labels(bucket_labels, label_values + (bound, ))
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            total = sum(counts[:-1])
+            le = format_labels(bucket_labels, label_values + ('+Inf', ))
+            labels = format_labels(self.labels, label_values)
+            lines.append(f"{self.name}_bucket{le} {total}")
+            lines.append(f"{self.name}_sum{labels} {counts[-1]:.6f}")
+            lines.append(f"{self.name}_count{labels} {total}")
+        return lines
+
+
+class MetricCounter:
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, *label_values, amount=1):
+        if not METRICS_ENABLED:
+            return
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values,
+                                                          0) + amount
+
+    def render(self):
+        with self._lock:
+            values = dict(self._values)
+        return [
+            f"{self.name}{format_labels(self.labels, label_values)} {value}"
+            for label_values, value in sorted(values.items())
+        ]
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+class MetricsRegistry:
+    """The process's metrics, rendered in the Prometheus text format on /metrics."""
+
+    def __init__(self):
+        self._metrics = []
+
+    def histogram(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        metric = Histogram(name, help_text, labels, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labels=()):
+        metric = MetricCounter(name, help_text, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self, gauges=()):
+        """Exposition text; `gauges` are (name, help, value) read at scrape time."""
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        for name, help_text, value in gauges:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+webhook_seconds = metrics.histogram('pulse_webhook_seconds',
+                                    'Inbound SMS handling time, by reply flow',
+                                    ('flow', ))
+storage_seconds = metrics.histogram('pulse_storage_seconds',
+                                    'Storage calls, by table and operation',
+                                    ('backend', 'table', 'operation'))
+storage_errors = metrics.counter('pulse_storage_errors_total',
+                                 'Storage calls that raised',
+                                 ('backend', 'table', 'operation'))
+action_seconds = metrics.histogram('pulse_action_seconds',
+                                   'Flow action run time, Gemini actions included',
+                                   ('action', ))
+twilio_send_seconds = metrics.histogram('pulse_twilio_send_seconds',
+                                        'Twilio messages.create calls, by outcome',
+                                        ('outcome', ))
+flow_loop_iterations = metrics.histogram(
+    'pulse_flow_loop_iterations',
+    'Engine loop iterations per run_steps call',
+    buckets=(1, 2, 3, 5, 8, 13, 21, 34, 50))
+scheduler_lag_seconds = metrics.histogram(
+    'pulse_scheduler_lag_seconds',
+    'Delay between a task execute_at and when it ran',
+    buckets=(0.1, 0.5, 1.0, 5.0, 15.0, 60.0, 300.0, 900.0, 3600.0))
+intake_submissions = metrics.counter(
+    'pulse_intake_submissions_total',
+    'Survey/Typeform submissions, by outcome', ('outcome', ))
+intake_batch_seconds = metrics.histogram(
+    'pulse_intake_batch_seconds',
+    'Time to apply one batch of survey/Typeform submissions')
+
+
+class RequestTrace:
+    """Timed spans for one sampled request, printed as one line when it ends."""
+
+    def __init__(self, name):
+        self.id = uuid.uuid4().hex[:12]
+        self.name = name
+        self.started = time.perf_counter()
+        self.spans = []
+
+    def add(self, name, label_values, started, elapsed):
+        self.spans.append({
+            'span': '.'.join((name, ) + tuple(map(str, label_values))),
+            'offset_ms': round((started - self.started) * 1000, 2),
+            'ms': round(elapsed * 1000, 2)
+        })
+
+    def finish(self):
+        total_ms = round((time.perf_counter() - self.started) * 1000, 2)
+        spans = ', '.join(f"{s['span']} @{s['offset_ms']} {s['ms']}ms"
+                          for s in self.spans)
+        print(f"Trace {self.id} {self.name} {total_ms}ms: {spans}")
+        recent_traces.append({
+            'id': self.id,
+            'name': self.name,
+            'total_ms': total_ms,
+            'spans': self.spans
+        })
+
+
+recent_traces = deque(maxlen=50)
+trace_local = threading.local()
+
+
+def start_trace(name):
+    """Begin a trace on this thread for a TRACE_SAMPLE_RATE share of calls."""
+    if TRACE_SAMPLE_RATE <= 0 or random.random() >= TRACE_SAMPLE_RATE:
+        return None
+    trace = trace_local.trace = RequestTrace(name)
+    return trace
+
+
+def end_trace(trace):
+    if trace is None:
+        return
+    trace_local.trace = None
+    trace.finish()
+
+
+@contextmanager
+def timed(histogram, *label_values):
+    """Observe the block's duration, and add it as a span to a sampled trace."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        histogram.observe(elapsed, *label_values)
+        trace = getattr(trace_local, 'trace', None)
+        if trace is not None:
+            trace.add(histogram.name, label_values, started, elapsed)
+
+
+def instrument_storage(method, table, operation):
+    def call(self, *args, **kwargs):
+        label_values = (self.name, table or args[0], operation)
+        try:
+            with timed(storage_seconds, *label_values):
+                return method(self, *args, **kwargs)
+        except Exception:
+            storage_errors.inc(*label_values)
+            raise
+
+    call.__name__ = method.__name__
+    call.__doc__ = method.__doc__
+    return call
+
+
+class LazyClient:
+    """Builds a client (and imports its SDK) on first use, then reuses it.
+
+    Workers boot without paying for SDKs or connections they may not need
+    yet, and with `gunicorn --preload` nothing network-bound is created in
+    the master before the fork. A factory that raises is not remembered:
+    the client is None for `RETRY_SECONDS`, then the next call builds it
+    again (a factory returning None, e.g. for missing credentials, is
+    final). `set` installs a ready-made instance, e.g. a stand-in for
+    tests or benchmarks.
+    """
+
+    RETRY_SECONDS = 5.0
+
+    def __init__(self, name, factory):
+        self.name = name
+        self._factory = factory
+        self._lock = threading.Lock()
+        self._built = False
+        self._value = None
+        self._retry_at = 0.0
+
+    def __call__(self):
+        if self._built:
+            return self._value
+        with self._lock:
+            if not self._built and time.monotonic() >= self._retry_at:
+                started = time.perf_counter()
+                try:
+                    self._value = self._factory()
+                    self._built = True
+                except Exception as e:
+                    print(f"Error: could not create {self.name} client, "
+                          f"retrying in {self.RETRY_SECONDS:g}s: {e}")
+                    self._value = None
+                    self._retry_at = time.monotonic() + self.RETRY_SECONDS
+                record_startup_phase(f"client_{self.name}", started)
+        return self._value
+
+    def set(self, value):
+        with self._lock:
+            self._value = value
+            self._built = True
+
+    def reset(self):
+        with self._lock:
+            self._value = None
+            self._built = False
+            self._retry_at = 0.0
+
+
+def build_supabase():
+    if not (SUPABASE_URL and SUPABASE_SERVICE_ROLE_KEY):
+        print("Warning: Supabase not connected.")
+        return None
+    from supabase import create_client
+    client = create_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)
     print("Supabase connected successfully.")
-else:
-    print("Warning: Supabase not connected.")
+    return client
 
-gemini_model = None
-if GEMINI_API_KEY:
-    genai.configure(api_key=GEMINI_API_KEY)
-    print("Gemini API key configured.")
 
-twilio_client = None
-if TWILIO_ACCOUNT_SID and TWILIO_AUTH_TOKEN:
-    twilio_client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
+get_supabase = LazyClient('supabase', build_supabase)
+
+
+class Storage:
+    """Persistence used by UserManager, ScheduleManager and ConversationLogger.
+
+    Rows are plain dicts shaped like the Supabase tables; timestamps are ISO
+    strings and scheduled_tasks rows carry {'users': {'phone': ...}}.
+    """
+
+    name = 'none'
+
+    # method -> (table, operation) for pulse_storage_seconds; a None table
+    # is taken from the first argument
+    OPERATIONS = {
+        'get_user': ('users', 'select'),
+        'create_user': ('users', 'insert'),
+        'update_user': ('users', 'update'),
+        'assign_users': ('users', 'upsert'),
+        'insert_task': ('scheduled_tasks', 'insert'),
+        'fetch_pending_tasks': ('scheduled_tasks', 'select'),
+        'claim_tasks': ('scheduled_tasks', 'update'),
+        'renew_lease': ('scheduled_tasks', 'update'),
+        'release_expired_leases': ('scheduled_tasks', 'update'),
+        'complete_tasks': ('scheduled_tasks', 'update'),
+        'count_overdue_tasks': ('scheduled_tasks', 'select'),
+        'insert_rows': (None, 'insert'),
+        'fetch_survey_responses': ('survey_responses', 'select'),
+        'update_survey_scores': ('survey_responses', 'update'),
+        'ping': ('health', 'ping')
+    }
+
+    _versioned = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        for method_name, (table, operation) in Storage.OPERATIONS.items():
+            if method_name in cls.__dict__:
+                setattr(
+                    cls, method_name,
+                    instrument_storage(cls.__dict__[method_name], table,
+                                       operation))
+
+    def get_user(self, phone):
+        raise NotImplementedError
+
+    def create_user(self, phone):
+        raise NotImplementedError
+
+    def update_user(self, phone, fields, expected_version=None):
+        """Write fields to the users row; returns False on a version conflict.
+
+        With `expected_version` the write only applies while users.version
+        still equals it, and bumps the version.
+        """
+        raise NotImplementedError
+
+    def assign_users(self, rows):
+        """Create or update users from {phone, slots, current_flow,
+        current_step_id} rows in one round trip where the backend allows,
+        bumping users.version of rows that already existed. Returns the
+        phones whose rows changed underneath the write and were skipped."""
+        raise NotImplementedError
+
+    def insert_task(self, row):
+        raise NotImplementedError
+
+    def fetch_pending_tasks(self, until):
+        raise NotImplementedError
+
+    def claim_tasks(self, task_ids, worker_id, lease_until):
+        raise NotImplementedError
+
+    def renew_lease(self, task_id, worker_id, lease_until):
+        """Extend a task's lease if `worker_id` still holds it; returns whether it does."""
+        raise NotImplementedError
+
+    def release_expired_leases(self, now):
+        raise NotImplementedError
+
+    def complete_tasks(self, task_ids, worker_id=None):
+        raise NotImplementedError
+
+    def count_overdue_tasks(self, before):
+        """Pending tasks due before `before`: {'count': n, 'oldest': execute_at}."""
+        raise NotImplementedError
+
+    def insert_rows(self, table, rows):
+        raise NotImplementedError
+
+    def fetch_survey_responses(self, slug, after_id, limit):
+        """Up to `limit` survey_responses rows for `slug` with id > after_id, by id."""
+        raise NotImplementedError
+
+    def update_survey_scores(self, rows):
+        """Write back profile and scores for fetched survey_responses rows."""
+        raise NotImplementedError
+
+    def ping(self):
+        """One cheap round trip; raises when the backend is unreachable."""
+        raise NotImplementedError
+
+    def supports_versions(self):
+        """Whether users has the optional version column, checked once.
+
+        Without it saves are last-writer-wins, so the session cache (a row
+        cached by another worker would be written back blindly) and the
+        version reads are skipped.
+        """
+        if self._versioned is None:
+            versioned = self.probe_version_column()
+            if versioned is None:
+                return False
+            self._versioned = versioned
+            if not versioned:
+                print("Warning: users.version is missing; session cache off, "
+                      "saves are last-writer-wins")
+        return self._versioned
+
+    def probe_version_column(self):
+        """True/False, or None while it cannot tell (e.g. no users yet)."""
+        return True
+
+
+class SupabaseStorage(Storage):
+    name = 'supabase'
+
+    def __init__(self, client):
+        self.client = client
+
+    def get_user(self, phone):
+        result = self.client.table('users').select('*').eq('phone',
+                                                           phone).execute()
+        return result.data[0] if result.data else None
+
+    def create_user(self, phone):
+        result = self.client.table('users').insert({
+            'phone': phone,
+            'status': 'Active',
+            'slots': {}
+        }).execute()
+        return result.data[0] if result.data else None
+
+    def update_user(self, phone, fields, expected_version=None):
+        if expected_version is None:
+            self.client.table('users').update(fields).eq('phone',
+                                                         phone).execute()
+            return True
+        result = self.client.table('users').update({
+            **fields, 'version': expected_version + 1
+        }).eq('phone', phone).eq('version', expected_version).execute()
+        return bool(result.data)
+
+    def assign_users(self, rows):
+        # PostgREST has no conditional upsert, so read the versions first:
+        # new users go in with one insert, existing ones are updated only
+        # while their version is still the one read
+        phones = [row['phone'] for row in rows]
+        columns = 'phone, version' if self.supports_versions() else 'phone'
+        result = self.client.table('users').select(columns)\
+            .in_('phone', phones).execute()
+        versions = {r['phone']: r.get('version') for r in result.data or []}
+        new = [{
+            **row, 'status': 'Active'
+        } for row in rows if row['phone'] not in versions]
+        if new:
+            self.client.table('users').insert(new).execute()
+        conflicts = []
+        for row in rows:
+            phone = row['phone']
+            if phone in versions and not self.update_user(
+                    phone, {k: v for k, v in row.items() if k != 'phone'},
+                    expected_version=versions[phone]):
+                conflicts.append(phone)
+        return conflicts
+
+    def insert_task(self, row):
+        result = self.client.table('scheduled_tasks').insert(row).execute()
+        return result.data[0] if result.data else None
+
+    def fetch_pending_tasks(self, until):
+        result = self.client.table('scheduled_tasks')\
+            .select('*, users(phone)')\
+            .eq('status', 'Pending')\
+            .lte('execute_at', until)\
+            .execute()
+        return result.data if result.data else []
+
+    def claim_tasks(self, task_ids, worker_id, lease_until):
+        result = self.client.table('scheduled_tasks').update({
+            'status': 'Claimed',
+            'claimed_by': worker_id,
+            'lease_expires_at': lease_until
+        }).in_('id', list(task_ids)).eq('status', 'Pending').execute()
+        return result.data if result.data else []
+
+    def renew_lease(self, task_id, worker_id, lease_until):
+        result = self.client.table('scheduled_tasks').update({
+            'lease_expires_at': lease_until
+        }).eq('id', task_id).eq('status', 'Claimed').eq('claimed_by',
+                                                        worker_id).execute()
+        return bool(result.data)
+
+    def release_expired_leases(self, now):
+        result = self.client.table('scheduled_tasks').update({
+            'status': 'Pending',
+            'claimed_by': None,
+            'lease_expires_at': None
+        }).eq('status', 'Claimed').lt('lease_expires_at', now).execute()
+        return result.data if result.data else []
+
+    def complete_tasks(self, task_ids, worker_id=None):
+        query = self.client.table('scheduled_tasks').update({
+            'status': 'Completed'
+        }).in_('id', list(task_ids))
+        if worker_id:
+            query = query.eq('status', 'Claimed').eq('claimed_by', worker_id)
+        query.execute()
+
+    def count_overdue_tasks(self, before):
+        result = self.client.table('scheduled_tasks')\
+            .select('execute_at', count='exact')\
+            .eq('status', 'Pending')\
+            .lt('execute_at', before)\
+            .order('execute_at')\
+            .limit(1)\
+            .execute()
+        return {
+            'count': result.count or 0,
+            'oldest': result.data[0]['execute_at'] if result.data else None
+        }
+
+    def insert_rows(self, table, rows):
+        self.client.table(table).insert(rows).execute()
+
+    def fetch_survey_responses(self, slug, after_id, limit):
+        result = self.client.table('survey_responses')\
+            .select('id, phone, survey_slug, answers, profile, scores')\
+            .eq('survey_slug', slug)\
+            .gt('id', after_id)\
+            .order('id')\
+            .limit(limit)\
+            .execute()
+        return result.data if result.data else []
+
+    def update_survey_scores(self, rows):
+        # the rows carry their NOT NULL columns, so the upsert only ever updates
+        self.client.table('survey_responses').upsert(
+            rows, on_conflict='id').execute()
+
+    def ping(self):
+        self.client.table('users').select('id').limit(1).execute()
+
+    def probe_version_column(self):
+        result = self.client.table('users').select('*').limit(1).execute()
+        if not result.data:
+            return None
+        return 'version' in result.data[0]
+
+
+class SQLStorage(Storage):
+    """Shared SQL for the direct Postgres and SQLite backends.
+
+    Subclasses supply the placeholder style and `_execute`, which runs one
+    statement and returns its rows as dicts.
+    """
+
+    placeholder = '?'
+    JSON_COLUMNS = ('slots', 'answers', 'scores')
+    USER_COLUMNS = frozenset([
+        'email', 'status', 'org_id', 'current_flow', 'current_step_id',
+        'slots', 'last_active'
+    ])
+    LOG_COLUMNS = {
+        'conversations':
+        frozenset([
+            'id', 'user_id', 'channel_id', 'flow_context', 'step_context',
+            'user_message', 'gemini_response'
+        ]),
+        'events':
+        frozenset(['user_id', 'category', 'content', 'conversation_ref']),
+        'survey_responses':
+        frozenset(['phone', 'survey_slug', 'answers', 'profile', 'scores'])
+    }
+
+    def _execute(self, sql, params=(), many=False):
+        raise NotImplementedError
+
+    def _encode_json(self, value):
+        return json.dumps(value)
+
+    def _decode_row(self, row):
+        for column in self.JSON_COLUMNS:
+            if isinstance(row.get(column), str):
+                row[column] = json.loads(row[column])
+        return row
+
+    def _ids(self, task_ids):
+        task_ids = list(task_ids)
+        return task_ids, ', '.join([self.placeholder] * len(task_ids))
+
+    def get_user(self, phone):
+        rows = self._execute(
+            f"SELECT * FROM users WHERE phone = {self.placeholder}", (phone, ))
+        return self._decode_row(rows[0]) if rows else None
+
+    def create_user(self, phone):
+        p = self.placeholder
+        rows = self._execute(
+            f"INSERT INTO users (id, phone, status, slots) "
+            f"VALUES ({p}, {p}, 'Active', {p}) RETURNING *",
+            (str(uuid.uuid4()), phone, self._encode_json({})))
+        return self._decode_row(rows[0]) if rows else None
+
+    def update_user(self, phone, fields, expected_version=None):
+        unknown = set(fields) - self.USER_COLUMNS
+        if unknown:
+            raise ValueError(f"Unknown users columns: {sorted(unknown)}")
+        p = self.placeholder
+        columns = sorted(fields)
+        values = [
+            self._encode_json(fields[c]) if c in self.JSON_COLUMNS else fields[c]
+            for c in columns
+        ]
+        assignments = ', '.join(f"{c} = {p}" for c in columns)
+        if expected_version is None:
+            self._execute(f"UPDATE users SET {assignments} WHERE phone = {p}",
+                          (*values, phone))
+            return True
+        rows = self._execute(
+            f"UPDATE users SET {assignments}, version = version + 1 "
+            f"WHERE phone = {p} AND version = {p} RETURNING version",
+            (*values, phone, expected_version))
+        return bool(rows)
+
+    def assign_users(self, rows):
+        p = self.placeholder
+        version = ", version = users.version + 1" \
+            if self.supports_versions() else ""
+        self._execute(
+            "INSERT INTO users (id, phone, status, slots, current_flow, current_step_id) "
+            f"VALUES ({p}, {p}, 'Active', {p}, {p}, {p}) "
+            "ON CONFLICT (phone) DO UPDATE SET slots = excluded.slots, "
+            "current_flow = excluded.current_flow, "
+            f"current_step_id = excluded.current_step_id{version}",
+            [(str(uuid.uuid4()), row['phone'], self._encode_json(row['slots']),
+              row['current_flow'], row['current_step_id']) for row in rows],
+            many=True)
+        # the version is bumped in the same statement, so nothing is skipped
+        return []
+
+    def insert_task(self, row):
+        p = self.placeholder
+        rows = self._execute(
+            f"INSERT INTO scheduled_tasks (user_id, flow_id, step_id, execute_at, status) "
+            f"VALUES ({p}, {p}, {p}, {p}, {p}) RETURNING *",
+            (row['user_id'], row['flow_id'], row['step_id'], row['execute_at'],
+             row.get('status', 'Pending')))
+        return rows[0] if rows else None
+
+    def fetch_pending_tasks(self, until):
+        rows = self._execute(
+            "SELECT t.*, u.phone AS user_phone FROM scheduled_tasks t "
+            "LEFT JOIN users u ON u.id = t.user_id "
+            f"WHERE t.status = 'Pending' AND t.execute_at <= {self.placeholder} "
+            "ORDER BY t.execute_at", (until, ))
+        for row in rows:
+            phone = row.pop('user_phone', None)
+            row['users'] = {'phone': phone} if phone else None
+        return rows
+
+    def claim_tasks(self, task_ids, worker_id, lease_until):
+        task_ids, marks = self._ids(task_ids)
+        if not task_ids:
+            return []
+        p = self.placeholder
+        return self._execute(
+            f"UPDATE scheduled_tasks SET status = 'Claimed', claimed_by = {p}, "
+            f"lease_expires_at = {p} WHERE id IN ({marks}) AND status = 'Pending' "
+            "RETURNING *", (worker_id, lease_until, *task_ids))
+
+    def renew_lease(self, task_id, worker_id, lease_until):
+        p = self.placeholder
+        return bool(self._execute(
+            f"UPDATE scheduled_tasks SET lease_expires_at = {p} WHERE id = {p} "
+            f"AND status = 'Claimed' AND claimed_by = {p} RETURNING id",
+            (lease_until, task_id, worker_id)))
+
+    def release_expired_leases(self, now):
+        return self._execute(
+            "UPDATE scheduled_tasks SET status = 'Pending', claimed_by = NULL, "
+            "lease_expires_at = NULL WHERE status = 'Claimed' "
+            f"AND lease_expires_at < {self.placeholder} RETURNING *", (now, ))
+
+    def complete_tasks(self, task_ids, worker_id=None):
+        task_ids, marks = self._ids(task_ids)
+        if not task_ids:
+            return
+        sql = f"UPDATE scheduled_tasks SET status = 'Completed' WHERE id IN ({marks})"
+        params = list(task_ids)
+        if worker_id:
+            sql += f" AND status = 'Claimed' AND claimed_by = {self.placeholder}"
+            params.append(worker_id)
+        self._execute(sql, params)
+
+    def count_overdue_tasks(self, before):
+        rows = self._execute(
+            "SELECT COUNT(*) AS count, MIN(execute_at) AS oldest "
+            "FROM scheduled_tasks WHERE status = 'Pending' "
+            f"AND execute_at < {self.placeholder}", (before, ))
+        return {'count': rows[0]['count'], 'oldest': rows[0]['oldest']}
+
+    def ping(self):
+        self._execute("SELECT 1")
+
+    def probe_version_column(self):
+        try:
+            self._execute("SELECT version FROM users LIMIT 1")
+            return True
+        except Exception as e:
+            return False if 'version' in str(e) else None
+
+    def insert_rows(self, table, rows):
+        if table not in self.LOG_COLUMNS:
+            raise ValueError(f"Unknown log table: {table}")
+        columns = sorted(rows[0])
+        if set(columns) - self.LOG_COLUMNS[table]:
+            raise ValueError(f"Unknown {table} columns: {columns}")
+        marks = ', '.join([self.placeholder] * len(columns))
+        self._execute(
+            f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({marks})",
+            [tuple(self._column_value(c, row.get(c)) for c in columns)
+             for row in rows],
+            many=True)
+
+    def _column_value(self, column, value):
+        if column in self.JSON_COLUMNS and value is not None:
+            return self._encode_json(value)
+        return value
+
+    def fetch_survey_responses(self, slug, after_id, limit):
+        p = self.placeholder
+        rows = self._execute(
+            "SELECT id, phone, survey_slug, answers, profile, scores "
+            f"FROM survey_responses WHERE survey_slug = {p} AND id > {p} "
+            f"ORDER BY id LIMIT {p}", (slug, after_id, limit))
+        return [self._decode_row(row) for row in rows]
+
+    def update_survey_scores(self, rows):
+        p = self.placeholder
+        self._execute(
+            f"UPDATE survey_responses SET profile = {p}, scores = {p} WHERE id = {p}",
+            [(row['profile'], self._encode_json(row['scores']), row['id'])
+             for row in rows],
+            many=True)
+
+
+class SQLiteStorage(SQLStorage):
+    """Local SQLite file in WAL mode, one connection per thread.
+
+    Creates its tables on first use, so tests and benchmarks can run with
+    no network at all.
+    """
+
+    name = 'sqlite'
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS users ("
+        "id TEXT PRIMARY KEY, phone TEXT UNIQUE, email TEXT UNIQUE, "
+        "status TEXT DEFAULT 'Active', org_id TEXT, current_flow TEXT, "
+        "current_step_id TEXT, slots TEXT DEFAULT '{}', last_active TEXT, "
+        "version INTEGER NOT NULL DEFAULT 0, "
+        "created_at TEXT DEFAULT CURRENT_TIMESTAMP)",
+        "CREATE TABLE IF NOT EXISTS conversations ("
+        "id INTEGER PRIMARY KEY, user_id TEXT, channel_id TEXT, "
+        "flow_context TEXT, step_context TEXT, user_message TEXT, "
+        "gemini_response TEXT, created_at TEXT DEFAULT CURRENT_TIMESTAMP)",
+        "CREATE TABLE IF NOT EXISTS events ("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT, user_id TEXT, category TEXT, "
+        "content TEXT, conversation_ref INTEGER, "
+        "occurred_at TEXT DEFAULT CURRENT_TIMESTAMP)",
+        "CREATE TABLE IF NOT EXISTS scheduled_tasks ("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT, user_id TEXT, flow_id TEXT, "
+        "step_id TEXT, execute_at TEXT, status TEXT DEFAULT 'Pending', "
+        "claimed_by TEXT, lease_expires_at TEXT)",
+        "CREATE INDEX IF NOT EXISTS scheduled_tasks_due "
+        "ON scheduled_tasks (status, execute_at)",
+        "CREATE TABLE IF NOT EXISTS survey_responses ("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT, phone TEXT NOT NULL, "
+        "survey_slug TEXT NOT NULL, answers TEXT NOT NULL, profile TEXT, "
+        "scores TEXT, created_at TEXT DEFAULT CURRENT_TIMESTAMP)",
+        "CREATE INDEX IF NOT EXISTS survey_responses_slug "
+        "ON survey_responses (survey_slug, id)",
+    )
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self._connection()
+        for statement in self.SCHEMA:
+            conn.execute(statement)
+        user_columns = {row['name'] for row in conn.execute('PRAGMA table_info(users)')}
+        if 'version' not in user_columns:
+            conn.execute("ALTER TABLE users ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path,
+                                   isolation_level=None,
+                                   check_same_thread=False,
+                                   timeout=10)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _execute(self, sql, params=(), many=False):
+        conn = self._connection()
+        if many:
+            conn.execute('BEGIN')
+            try:
+                conn.executemany(sql, params)
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            return []
+        return [dict(row) for row in conn.execute(sql, tuple(params))]
+
+
+class PostgresStorage(SQLStorage):
+    """Direct Postgres through a psycopg connection pool with prepared statements."""
+
+    name = 'postgres'
+    placeholder = '%s'
+
+    def __init__(self, dsn, min_size=1, max_size=10):
+        try:
+            from psycopg.rows import dict_row
+            from psycopg.types.json import Jsonb
+            from psycopg_pool import ConnectionPool
+        except ImportError as e:
+            raise RuntimeError(
+                "STORAGE_BACKEND=postgres needs the psycopg[binary] and "
+                "psycopg-pool packages") from e
+        self._jsonb = Jsonb
+        self.pool = ConnectionPool(dsn,
+                                   min_size=min_size,
+                                   max_size=max_size,
+                                   kwargs={
+                                       'autocommit': True,
+                                       'row_factory': dict_row,
+                                       'prepare_threshold': 0
+                                   })
+
+    def _encode_json(self, value):
+        return self._jsonb(value)
+
+    def _ids(self, task_ids):
+        return [list(task_ids)], 'SELECT unnest(%s::bigint[])'
+
+    @staticmethod
+    def _plain(row):
+        for key, value in row.items():
+            if isinstance(value, datetime):
+                row[key] = value.isoformat()
+            elif isinstance(value, uuid.UUID):
+                row[key] = str(value)
+        return row
+
+    def _execute(self, sql, params=(), many=False):
+        with self.pool.connection() as conn:
+            with conn.cursor() as cur:
+                if many:
+                    with conn.transaction():
+                        cur.executemany(sql, params)
+                    return []
+                cur.execute(sql, tuple(params), prepare=True)
+                if cur.description is None:
+                    return []
+                return [self._plain(row) for row in cur.fetchall()]
+
+
+def create_storage():
+    # errors propagate so get_storage retries instead of staying disabled
+    if STORAGE_BACKEND == 'sqlite':
+        print(f"Storage: SQLite at {SQLITE_PATH}")
+        return SQLiteStorage(SQLITE_PATH)
+    if STORAGE_BACKEND == 'postgres':
+        print("Storage: direct Postgres pool")
+        return PostgresStorage(DATABASE_URL, PG_POOL_MIN, PG_POOL_MAX)
+    supabase = get_supabase()
+    if supabase:
+        return SupabaseStorage(supabase)
+    if SUPABASE_URL and SUPABASE_SERVICE_ROLE_KEY:
+        raise RuntimeError("Supabase client is not available yet")
+    return None
+
+
+get_storage = LazyClient('storage', create_storage)
+
+
+def create_twilio_http_client():
+    """Keep-alive session sized so every send worker can hold a connection."""
+    from twilio.http.http_client import TwilioHttpClient
+    from requests.adapters import HTTPAdapter
+    http_client = TwilioHttpClient(pool_connections=True,
+                                   timeout=TWILIO_HTTP_TIMEOUT)
+    http_client.session.mount(
+        'https://',
+        HTTPAdapter(pool_connections=4,
+                    pool_maxsize=max(TWILIO_SEND_WORKERS, 1)))
+    return http_client
+
+
+def build_twilio_client():
+    if not (TWILIO_ACCOUNT_SID and TWILIO_AUTH_TOKEN):
+        return None
+    from twilio.rest import Client
+    return Client(TWILIO_ACCOUNT_SID,
+                  TWILIO_AUTH_TOKEN,
+                  http_client=create_twilio_http_client())
+
+
+get_twilio = LazyClient('twilio', build_twilio_client)
+
+
+class SessionCache:
+    """Bounded LRU cache of users rows keyed by phone, with a per-entry TTL.
+
+    Writes go to Supabase first and are then applied to the cached row, so
+    the database stays the source of truth. A size or TTL of 0 disables it.
+    """
+
+    def __init__(self, max_entries=1000, ttl_seconds=300):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0 and self.ttl_seconds > 0
+
+    def get(self, phone):
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(phone)
+            if entry is None:
+                self.misses += 1
+                return None
+            stored_at, row = entry
+            if time.monotonic() - stored_at > self.ttl_seconds:
+                del self._entries[phone]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(phone)
+            self.hits += 1
+            return copy.deepcopy(row)
+
+    def put(self, phone, row):
+        if not self.enabled or not row:
+            return
+        with self._lock:
+            self._entries[phone] = (time.monotonic(), copy.deepcopy(row))
+            self._entries.move_to_end(phone)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def update(self, phone, fields):
+        if not self.enabled:
+            return
+        with self._lock:
+            entry = self._entries.get(phone)
+            if entry is None:
+                return
+            row = entry[1]
+            row.update(copy.deepcopy(fields))
+            self._entries[phone] = (time.monotonic(), row)
+            self._entries.move_to_end(phone)
+
+    def invalidate(self, phone):
+        with self._lock:
+            self._entries.pop(phone, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'size': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl_seconds': self.ttl_seconds,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations
+            }
+
+
+session_cache = SessionCache(SESSION_CACHE_SIZE, SESSION_CACHE_TTL)
+
+
+class SessionConflict(Exception):
+    """The users row changed (version bumped) since this session loaded it."""
+
+
+class PhoneLocks:
+    """Sharded locks that let one conversation turn per phone run at a time.
+
+    Two quick messages from the same user no longer interleave their
+    load -> process -> save, while different users only contend when
+    their phones hash to the same shard. These are plain Locks, not
+    RLocks, so a deferred reply can carry its lock to the reply thread and
+    release it there. Across processes the users.version check in
+    `UserManager.save_session` catches what these locks cannot.
+    """
+
+    def __init__(self, shards, timeout):
+        self.timeout = timeout
+        self._locks = [threading.Lock() for _ in range(max(shards, 1))]
+        self._stats_lock = threading.Lock()
+        self.waits = 0
+        self.timeouts = 0
+        self.conflicts = 0
+
+    def acquire(self, phone):
+        """The held lock for `phone`, or None if it could not be had in time."""
+        lock = self._locks[hash(phone) % len(self._locks)]
+        if lock.acquire(blocking=False):
+            return lock
+        self._count('waits')
+        if lock.acquire(timeout=self.timeout):
+            return lock
+        self._count('timeouts')
+        print(f"Warning: waited {self.timeout}s for {phone}, continuing without the phone lock")
+        return None
+
+    def record_conflict(self):
+        self._count('conflicts')
+
+    def _count(self, key):
+        with self._stats_lock:
+            setattr(self, key, getattr(self, key) + 1)
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'shards': len(self._locks),
+                'waits': self.waits,
+                'timeouts': self.timeouts,
+                'conflicts': self.conflicts
+            }
+
+
+phone_locks = PhoneLocks(PHONE_LOCK_SHARDS, PHONE_LOCK_TIMEOUT)
 
 
 class UserManager:
 
     @staticmethod
     def get_or_create_user(phone):
-        if not supabase:
+        storage = get_storage()
+        if not storage:
             return None
+        cacheable = storage.supports_versions()
+        cached = session_cache.get(phone) if cacheable else None
+        if cached:
+            return cached
         try:
-            result = supabase.table('users').select('*').eq('phone',
-                                                            phone).execute()
-            if result.data and len(result.data) > 0:
-                return result.data[0]
-
-            new_user = supabase.table('users').insert({
-                'phone': phone,
-                'status': 'Active',
-                'slots': {}
-            }).execute()
-            if new_user.data:
-                return new_user.data[0]
+            user = storage.get_user(phone) or storage.create_user(phone)
+            if user:
+                if cacheable:
+                    session_cache.put(phone, user)
+                return user
         except Exception as e:
             print(f"Error getting/creating user: {e}")
         return None
@@ -95,13 +1211,22 @@ class UserManager:
             'step_order': int(user.get('current_step_id', '0') or '0'),
             'slots': slots,
             'pending_slot': slots.get('_pending_slot'),
-            'timezone': 'America/New_York'
+            'timezone': 'America/New_York',
+            'version': user.get('version')
         }
 
     @staticmethod
-    def save_session(phone, session):
-        if not supabase:
+    def save_session(phone, session, force=False):
+        """Persist the session; raises SessionConflict if the row moved on.
+
+        With `force` (a turn whose actions already ran) a moved row is
+        overwritten instead. Rows without a version column are written
+        unconditionally.
+        """
+        storage = get_storage()
+        if not storage:
             return
+        version = session.get('version')
         try:
             step_id = str(session.get('step_order', 0))
             slots = session.get('slots', {})
@@ -110,34 +1235,194 @@ class UserManager:
             elif '_pending_slot' in slots:
                 del slots['_pending_slot']
 
-            supabase.table('users').update({
-                'current_flow':
-                session.get('current_flow'),
-                'current_step_id':
-                step_id,
-                'slots':
-                slots,
-                'last_active':
-                datetime.utcnow().isoformat()
-            }).eq('phone', phone).execute()
-
+            fields = {
+                'current_flow': session.get('current_flow'),
+                'current_step_id': step_id,
+                'slots': slots,
+                'last_active': datetime.utcnow().isoformat()
+            }
+            if not storage.update_user(phone, fields, expected_version=version):
+                session_cache.invalidate(phone)
+                phone_locks.record_conflict()
+                if not force:
+                    raise SessionConflict(phone)
+                print(f"Session for {phone} changed after this turn's actions ran, keeping this turn's state")
+                try:
+                    session['version'] = UserManager.overwrite(phone, fields)
+                except SessionConflict:
+                    print(f"Error saving session: {phone} kept changing, turn not saved")
+                return
+            if version is not None:
+                fields['version'] = session['version'] = version + 1
+            session_cache.update(phone, fields)
+
+        except SessionConflict:
+            raise
         except Exception as e:
+            session_cache.invalidate(phone)
             print(f"Error saving session: {e}")
 
+    @staticmethod
+    def overwrite(phone, fields):
+        """Write fields whatever the session holds, still bumping the version
+        so that any turn in flight for this phone notices and retries.
+        Returns the new version (None without a version column)."""
+        storage = get_storage()
+        for _ in range(SESSION_MAX_RETRIES + 1):
+            user = UserManager.get_or_create_user(phone)
+            version = user.get('version') if user else None
+            if storage.update_user(phone, fields, expected_version=version):
+                if version is not None:
+                    version += 1
+                    fields = {**fields, 'version': version}
+                session_cache.update(phone, fields)
+                return version
+            session_cache.invalidate(phone)
+        raise SessionConflict(phone)
+
+    @staticmethod
+    def stored_version(phone):
+        """users.version straight from storage, bypassing the session cache."""
+        storage = get_storage()
+        user = storage.get_user(phone) if storage else None
+        return user.get('version') if user else None
+
+    @staticmethod
+    def update_slots(phone, changes):
+        """Merge `changes` into the stored slots without touching flow state.
+
+        Re-reads the row on every attempt, so slots written by a turn in
+        flight are kept. Returns False when there is no user or nothing
+        would change.
+        """
+        storage = get_storage()
+        if not storage:
+            return False
+        for _ in range(SESSION_MAX_RETRIES + 1):
+            user = storage.get_user(phone)
+            if not user:
+                return False
+            slots = user.get('slots') or {}
+            if all(slots.get(k) == v for k, v in changes.items()):
+                return False
+            if storage.update_user(phone, {'slots': {**slots, **changes}},
+                                   expected_version=user.get('version')):
+                session_cache.invalidate(phone)
+                return True
+        raise SessionConflict(phone)
+
+    @staticmethod
+    def assign_flow(phone, flow_id, slots):
+        storage = get_storage()
+        if not storage:
+            return
+        fields = {
+            'slots': slots,
+            'current_flow': flow_id,
+            'current_step_id': '0'
+        }
+        try:
+            UserManager.overwrite(phone, fields)
+        except Exception:
+            session_cache.invalidate(phone)
+            raise
+
     @staticmethod
     def clear_session(phone):
-        if not supabase:
+        storage = get_storage()
+        if not storage:
             return
         try:
-            supabase.table('users').update({
+            UserManager.overwrite(phone, {
                 'current_flow': None,
                 'current_step_id': None,
                 'slots': {}
-            }).eq('phone', phone).execute()
+            })
         except Exception as e:
+            session_cache.invalidate(phone)
             print(f"Error clearing session: {e}")
 
 
+class RequestSession:
+    """Flow state for one phone, loaded once per request and flushed once.
+
+    Behaves like the session dict the engine has always used, but remembers
+    what was loaded so that `flush` only writes the users row when a tracked
+    field actually changed.
+
+    A turn that hits a SessionConflict is replayed from the fresh row, which
+    is only safe while it has done nothing but compute. `begin_side_effects`
+    re-checks users.version before the first action or schedule step, and
+    once those have run a conflicting flush overwrites instead of raising,
+    so tasks, log rows and Gemini calls are never repeated.
+    """
+
+    TRACKED_FIELDS = ('current_flow', 'step_order', 'slots', 'pending_slot')
+
+    def __init__(self, phone, data):
+        self.phone = phone
+        self.data = data
+        self.reply_flow = None
+        self.snapshot = db.current()
+        self.side_effects = False
+        self._baseline = self._snapshot()
+
+    @classmethod
+    def load(cls, phone):
+        data = UserManager.get_session(phone)
+        if not data:
+            data = {
+                'user_id': None,
+                'current_flow': None,
+                'step_order': 0,
+                'slots': {},
+                'pending_slot': None,
+                'timezone': 'America/New_York'
+            }
+        return cls(phone, data)
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def _snapshot(self):
+        return copy.deepcopy(
+            {field: self.data.get(field)
+             for field in self.TRACKED_FIELDS})
+
+    def is_dirty(self):
+        return self._snapshot() != self._baseline
+
+    def begin_side_effects(self):
+        """Raise SessionConflict now, while a replay is still harmless, if
+        another process saved this user since the session was loaded."""
+        if self.side_effects:
+            return
+        version = self.data.get('version')
+        if version is not None and UserManager.stored_version(
+                self.phone) != version:
+            session_cache.invalidate(self.phone)
+            phone_locks.record_conflict()
+            raise SessionConflict(self.phone)
+        self.side_effects = True
+
+    def flush(self):
+        if not self.is_dirty():
+            return False
+        UserManager.save_session(self.phone, self.data,
+                                 force=self.side_effects)
+        self._baseline = self._snapshot()
+        return True
+
+
 class ScheduleManager:
 
     @staticmethod
@@ -148,8 +1433,10 @@ class ScheduleManager:
                       delay_hours=None,
                       delay_days=None,
                       resume_time=None,
-                      resume_weekday=None):
-        if not supabase or not user_id:
+                      resume_weekday=None,
+                      phone=None):
+        storage = get_storage()
+        if not storage or not user_id:
             return
 
         try:
@@ -187,52 +1474,298 @@ class ScheduleManager:
         run_at_utc = run_at_local.astimezone(pytz.UTC)
 
         try:
-            supabase.table('scheduled_tasks').insert({
-                'user_id':
-                user_id,
-                'flow_id':
-                flow_id,
-                'step_id':
-                step_id,
-                'execute_at':
-                run_at_utc.isoformat(),
-                'status':
-                'Pending'
-            }).execute()
+            task = storage.insert_task({
+                'user_id': user_id,
+                'flow_id': flow_id,
+                'step_id': step_id,
+                'execute_at': run_at_utc.isoformat(),
+                'status': 'Pending'
+            })
             print(f"Scheduled task for user {user_id} at {run_at_utc} UTC")
+            if task and phone:
+                scheduler_engine.add({**task, 'users': {'phone': phone}})
         except Exception as e:
             print(f"Error scheduling task: {e}")
 
+    @staticmethod
+    def fetch_due_tasks(until):
+        return get_storage().fetch_pending_tasks(until.isoformat())
+
     @staticmethod
     def get_due_tasks():
-        if not supabase:
+        storage = get_storage()
+        if not storage:
             return []
         try:
-            now = datetime.utcnow().isoformat()
-            result = supabase.table('scheduled_tasks')\
-                .select('*, users(phone)')\
-                .eq('status', 'Pending')\
-                .lte('execute_at', now)\
-                .execute()
-            return result.data if result.data else []
+            return ScheduleManager.fetch_due_tasks(datetime.now(pytz.UTC))
         except Exception as e:
             print(f"Error getting due tasks: {e}")
             return []
 
+    @staticmethod
+    def claim_tasks(task_ids, worker_id, lease_until):
+        """Atomically move Pending tasks to Claimed; returns only the rows this worker won."""
+        storage = get_storage()
+        if not storage or not task_ids:
+            return []
+        try:
+            return storage.claim_tasks(task_ids, worker_id,
+                                       lease_until.isoformat())
+        except Exception as e:
+            print(f"Error claiming tasks: {e}")
+            return []
+
+    @staticmethod
+    def renew_lease(task_id, worker_id):
+        """Re-check that this worker still holds the task and extend its lease."""
+        storage = get_storage()
+        if not storage:
+            return False
+        lease_until = datetime.now(pytz.UTC) + timedelta(
+            seconds=SCHEDULER_LEASE_SECONDS)
+        try:
+            return storage.renew_lease(task_id, worker_id,
+                                       lease_until.isoformat())
+        except Exception as e:
+            print(f"Error renewing lease on task {task_id}: {e}")
+            return False
+
+    @staticmethod
+    def release_expired_leases():
+        storage = get_storage()
+        if not storage:
+            return []
+        try:
+            released = storage.release_expired_leases(
+                datetime.now(pytz.UTC).isoformat())
+            if released:
+                print(f"Released {len(released)} scheduled tasks with expired leases")
+            return released
+        except Exception as e:
+            print(f"Error releasing expired leases: {e}")
+            return []
+
+    @staticmethod
+    def mark_completed_many(task_ids, worker_id):
+        task_ids = list(task_ids)
+        storage = get_storage()
+        if not storage or not task_ids:
+            return
+        try:
+            storage.complete_tasks(task_ids, worker_id)
+        except Exception as e:
+            print(f"Error marking {len(task_ids)} tasks completed: {e}")
+
     @staticmethod
     def mark_completed(task_id):
-        if not supabase:
+        storage = get_storage()
+        if not storage:
             return
         try:
-            supabase.table('scheduled_tasks').update({
-                'status': 'Completed'
-            }).eq('id', task_id).execute()
+            storage.complete_tasks([task_id])
         except Exception as e:
             print(f"Error marking task completed: {e}")
 
 
+class LogPipeline:
+    """Bounded queue of conversations/events rows drained by one flusher thread.
+
+    Rows are written with multi-row inserts once `batch_size` rows are
+    waiting or the oldest has waited `flush_interval` seconds. When the
+    queue is full, the 'block' policy waits briefly for room (backpressure)
+    before dropping, and 'drop' discards the row immediately.
+    """
+
+    STOP = object()
+    TABLE_ORDER = ('conversations', 'events')
+
+    def __init__(self,
+                 max_queue=10000,
+                 batch_size=50,
+                 flush_interval=1.0,
+                 policy='block',
+                 block_timeout=0.5):
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._thread = None
+        self.enqueued = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.batches = 0
+
+    def _ensure_started(self):
+        if self._thread and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run,
+                                            name='log-flusher',
+                                            daemon=True)
+            self._thread.start()
+
+    def submit(self, table, row):
+        self._ensure_started()
+        try:
+            if self.policy == 'block':
+                self._queue.put((table, row), timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait((table, row))
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            print(f"Log queue full, dropped {table} row")
+            return False
+        with self._lock:
+            self.enqueued += 1
+        return True
+
+    def _run(self):
+        batch = []
+        deadline = None
+        while True:
+            wait = self.flush_interval
+            if batch:
+                wait = max(0.0, deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=wait)
+            except queue.Empty:
+                item = None
+
+            if item is self.STOP:
+                self._flush(batch)
+                self._queue.task_done()
+                return
+            if item is not None:
+                if not batch:
+                    deadline = time.monotonic() + self.flush_interval
+                batch.append(item)
+
+            if batch and (len(batch) >= self.batch_size
+                          or time.monotonic() >= deadline):
+                self._flush(batch)
+                batch = []
+
+    def _flush(self, batch):
+        if not batch:
+            return
+        by_table = {}
+        for table, row in batch:
+            by_table.setdefault(table, []).append(row)
+        for table in sorted(by_table,
+                            key=lambda t: self.TABLE_ORDER.index(t)
+                            if t in self.TABLE_ORDER else len(self.TABLE_ORDER)):
+            storage = get_storage()
+            if storage:
+                self._write(storage, table, by_table[table])
+        with self._lock:
+            self.batches += 1
+        for _ in batch:
+            self._queue.task_done()
+
+    def _write(self, storage, table, rows, split=True):
+        """Insert rows, splitting a failed insert in halves so that one bad
+        row (a duplicate id, an oversized text) only costs itself. An
+        unreachable backend fails the rows without splitting."""
+        try:
+            storage.insert_rows(table, rows)
+            with self._lock:
+                self.written += len(rows)
+            return
+        except Exception as e:
+            error = e
+        if len(rows) > 1 and split:
+            try:
+                storage.ping()
+            except Exception:
+                split = False
+        if len(rows) == 1 or not split:
+            with self._lock:
+                self.failed += len(rows)
+            print(f"Logging Error ({table}, {len(rows)} rows): {error}")
+            return
+        middle = len(rows) // 2
+        self._write(storage, table, rows[:middle])
+        self._write(storage, table, rows[middle:])
+
+    def drain(self, timeout=5.0):
+        end = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < end:
+            time.sleep(0.01)
+        return not self._queue.unfinished_tasks
+
+    def shutdown(self, timeout=5.0):
+        if not self._thread or not self._thread.is_alive():
+            return
+        try:
+            self._queue.put(self.STOP, timeout=timeout)
+        except queue.Full:
+            print("Log queue full at shutdown, pending rows lost")
+            return
+        self._thread.join(timeout)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'queue_depth': self._queue.qsize(),
+                'capacity': self._queue.maxsize,
+                'enqueued': self.enqueued,
+                'written': self.written,
+                'dropped': self.dropped,
+                'failed': self.failed,
+                'batches': self.batches,
+                'policy': self.policy
+            }
+
+
+log_pipeline = LogPipeline(max_queue=LOG_QUEUE_SIZE,
+                           batch_size=LOG_BATCH_SIZE,
+                           flush_interval=LOG_FLUSH_INTERVAL,
+                           policy=LOG_QUEUE_POLICY)
+atexit.register(log_pipeline.shutdown)
+
+
 class ConversationLogger:
 
+    ID_EPOCH_MS = 1704067200000
+    _id_lock = threading.Lock()
+    _id_state = {'ms': 0, 'seq': 0, 'pid': None, 'node': 0}
+
+    @staticmethod
+    def node_id():
+        """LOG_NODE_ID when set (unique per process is up to the deployment),
+        else a 16-bit hash of hostname and pid, so processes on different
+        hosts or with pids sharing low bits still get different nodes."""
+        if LOG_NODE_ID:
+            return int(LOG_NODE_ID) & 0xFFFF
+        digest = hashlib.sha1(
+            f"{socket.gethostname()}:{os.getpid()}".encode('utf-8')).digest()
+        return int.from_bytes(digest[:2], 'big')
+
+    @staticmethod
+    def next_id():
+        """Time-ordered 63-bit id: milliseconds | 16-bit node | 6-bit sequence."""
+        with ConversationLogger._id_lock:
+            state = ConversationLogger._id_state
+            if state['pid'] != os.getpid():
+                state['pid'] = os.getpid()
+                state['node'] = ConversationLogger.node_id()
+            now_ms = int(time.time() * 1000) - ConversationLogger.ID_EPOCH_MS
+            if now_ms <= state['ms']:
+                state['seq'] = (state['seq'] + 1) & 0x3F
+                if state['seq'] == 0:
+                    state['ms'] += 1
+                now_ms = state['ms']
+            else:
+                state['ms'] = now_ms
+                state['seq'] = 0
+            return (now_ms << 22) | (state['node'] << 6) | state['seq']
+
     @staticmethod
     def log(user_id,
             channel_id,
@@ -240,93 +1773,746 @@ class ConversationLogger:
             gemini_response,
             flow_context=None,
             step_context=None):
-        if not supabase or not user_id:
+        storage = get_storage()
+        if not storage or not user_id:
             return None
-        try:
-            result = supabase.table('conversations').insert({
-                'user_id':
-                user_id,
-                'channel_id':
-                channel_id,
-                'flow_context':
-                flow_context,
-                'step_context':
-                step_context,
-                'user_message':
-                user_message,
-                'gemini_response':
-                gemini_response
-            }).execute()
-            if result.data:
-                return result.data[0].get('id')
-        except Exception as e:
-            print(f"Logging Error: {e}")
-        return None
+        conversation_id = ConversationLogger.next_id()
+        queued = log_pipeline.submit(
+            'conversations', {
+                'id': conversation_id,
+                'user_id': user_id,
+                'channel_id': channel_id,
+                'flow_context': flow_context,
+                'step_context': step_context,
+                'user_message': user_message,
+                'gemini_response': gemini_response
+            })
+        return conversation_id if queued else None
 
     @staticmethod
     def log_event(user_id, category, content, conversation_ref=None):
-        if not supabase or not user_id:
+        storage = get_storage()
+        if not storage or not user_id:
             return
+        log_pipeline.submit(
+            'events', {
+                'user_id': user_id,
+                'category': category,
+                'content': content,
+                'conversation_ref': conversation_ref
+            })
+
+
+class TriggerIndex:
+    """Aho-Corasick automaton over every flow trigger, built once per load.
+
+    `match` walks the upper-cased message once and returns the same flow the
+    old flow-by-flow substring scan picked: the first flow, in load order,
+    that has any trigger contained in the text.
+    """
+
+    def __init__(self, flows):
+        self.flow_ids = []
+        self.patterns = []
+        self.warnings = []
+        self._goto = [{}]
+        self._fail = [0]
+        self._best = [None]
+
+        for flow_id, flow_data in flows.items():
+            priority = len(self.flow_ids)
+            self.flow_ids.append(flow_id)
+            seen = set()
+            for trigger in self.normalize_triggers(
+                    flow_data.get('triggers', [])):
+                if not trigger:
+                    self.warnings.append(
+                        f"Empty trigger ignored in flow '{flow_id}'")
+                    continue
+                if trigger in seen:
+                    continue
+                seen.add(trigger)
+                self._add(trigger, priority)
+                self.patterns.append((trigger, priority))
+
+        self._link()
+        self._report_shadowing()
+
+    @staticmethod
+    def normalize_triggers(triggers):
+        if not triggers:
+            return []
+        if isinstance(triggers, str):
+            triggers = [t.strip() for t in triggers.split(',') if t.strip()]
+        return [str(t).upper() for t in triggers]
+
+    def _add(self, trigger, priority):
+        node = 0
+        for ch in trigger:
+            nxt = self._goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[node][ch] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._best.append(None)
+            node = nxt
+        if self._best[node] is None or priority < self._best[node]:
+            self._best[node] = priority
+
+    def _link(self):
+        queue = list(self._goto[0].values())
+        head = 0
+        while head < len(queue):
+            node = queue[head]
+            head += 1
+            for ch, child in self._goto[node].items():
+                fail = self._fail[node]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                target = self._goto[fail].get(ch, 0)
+                self._fail[child] = target if target != child else 0
+                inherited = self._best[self._fail[child]]
+                if inherited is not None and (self._best[child] is None or
+                                              inherited < self._best[child]):
+                    self._best[child] = inherited
+                queue.append(child)
+
+    def _scan(self, text):
+        goto, fail, best = self._goto, self._fail, self._best
+        node = 0
+        found = None
+        for ch in text:
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            hit = best[node]
+            if hit is not None and (found is None or hit < found):
+                found = hit
+                if found == 0:
+                    break
+        return found
+
+    def _report_shadowing(self):
+        owners = {}
+        for trigger, priority in self.patterns:
+            flow_id = self.flow_ids[priority]
+            if trigger in owners:
+                self.warnings.append(
+                    f"Ambiguous trigger '{trigger}': flow '{flow_id}' is "
+                    f"shadowed by '{owners[trigger]}'")
+                continue
+            owners[trigger] = flow_id
+            winner = self._scan(trigger)
+            if winner is not None and winner < priority:
+                self.warnings.append(
+                    f"Trigger '{trigger}' in flow '{flow_id}' is shadowed by "
+                    f"flow '{self.flow_ids[winner]}'")
+
+    def match(self, text):
+        priority = self._scan(text.upper())
+        if priority is None:
+            return None
+        return self.flow_ids[priority]
+
+
+def compile_guard(guard_str):
+    """Parse a branch/validate condition once into a (user_input, slots) predicate.
+
+    Returns None for conditions the engine does not understand; those have
+    always evaluated to False.
+    """
+    if not guard_str:
+        return None
+
+    if "input !=" in guard_str:
+        target = guard_str.split("!=")[1].strip().replace("'", "").replace(
+            '"', "").upper()
+        return lambda user_input, slots: user_input.upper() != target
+
+    if "ai_analysis.category ==" in guard_str:
+        target = guard_str.split("==")[1].strip().replace("'", "").replace(
+            '"', "")
+        return lambda user_input, slots: slots.get('ai_analysis', {}).get(
+            'category') == target
+
+    return None
+
+
+class StepTemplate:
+    """Step content split once into literal text and {slot} placeholders."""
+
+    __slots__ = ('parts', )
+
+    PLACEHOLDER = re.compile(r'\{([^{}]*)\}')
+
+    def __init__(self, text):
+        parts = []
+        pos = 0
+        for match in self.PLACEHOLDER.finditer(text):
+            if match.start() > pos:
+                parts.append((False, text[pos:match.start()]))
+            parts.append((True, match.group(1)))
+            pos = match.end()
+        if pos < len(text):
+            parts.append((False, text[pos:]))
+        self.parts = tuple(parts)
+
+    def render(self, slots):
+        out = []
+        for is_slot, value in self.parts:
+            if not is_slot:
+                out.append(value)
+            elif value in slots:
+                slot_value = slots[value]
+                out.append(str(slot_value) if slot_value is not None else "")
+            else:
+                out.append(f"{{{value}}}")
+        return "".join(out)
+
+
+LLM_ACTIONS = frozenset(['analyze_stress_gemini', 'generate_profile_insights'])
+
+
+class CompiledStep:
+    __slots__ = ('index', 'step_id', 'type', 'content', 'template',
+                 'variable', 'action_name', 'condition', 'guard',
+                 'target_flow', 'target', 'delay_hours', 'delay_days',
+                 'resume_time', 'resume_weekday', 'async_reply')
+
+    def __init__(self, index, step):
+        content = step.get('content')
+        condition = step.get('condition')
+        self.index = index
+        self.step_id = step.get('id')
+        self.type = step.get('type')
+        self.content = content
+        self.template = StepTemplate(content) if isinstance(content,
+                                                            str) else None
+        self.variable = step.get('variable')
+        self.action_name = step.get('action_name')
+        self.condition = condition
+        self.guard = compile_guard(condition)
+        self.target_flow = step.get('target_flow')
+        self.target = None
+        self.delay_hours = step.get('delay_hours')
+        self.delay_days = step.get('delay_days')
+        self.resume_time = step.get('resume_time')
+        self.resume_weekday = step.get('resume_weekday')
+        self.async_reply = step.get('async_reply')
+
+    def render(self, slots):
+        if self.template is None:
+            return self.content or ""
+        return self.template.render(slots)
+
+
+class CompiledFlow:
+    __slots__ = ('flow_id', 'steps', 'is_locked', 'collect_vars',
+                 'async_reply_ack')
+
+    def __init__(self, flow_id, flow_data):
+        self.flow_id = flow_id
+        self.steps = tuple(
+            CompiledStep(index, step)
+            for index, step in enumerate(flow_data.get('steps') or []))
+        self.is_locked = bool(flow_data.get('is_locked'))
+        self.collect_vars = frozenset(
+            step.variable for step in self.steps
+            if step.type == 'collect' and step.variable)
+        self.async_reply_ack = flow_data.get('async_reply_ack')
+
+        flow_async = bool(flow_data.get('async_reply'))
+        for step in self.steps:
+            if step.async_reply is None:
+                step.async_reply = (flow_async and step.type == 'action'
+                                    and step.action_name in LLM_ACTIONS)
+            step.async_reply = bool(step.async_reply)
+
+
+class FlowGraph:
+    """Every flow compiled into step objects with branch targets linked.
+
+    Built once per load so the conversation loop only follows references;
+    targets that name an undefined flow are reported here instead of
+    silently ending a conversation at runtime.
+    """
+
+    def __init__(self, flows):
+        self.flows = {
+            flow_id: CompiledFlow(flow_id, flow_data)
+            for flow_id, flow_data in flows.items()
+        }
+        self.warnings = []
+
+        for flow in self.flows.values():
+            for step in flow.steps:
+                where = f"flow '{flow.flow_id}' step '{step.step_id or step.index}'"
+                if step.condition and step.guard is None:
+                    self.warnings.append(
+                        f"Unsupported condition \"{step.condition}\" in {where} never matches")
+                if step.target_flow:
+                    step.target = self.flows.get(step.target_flow)
+                    if step.target is None:
+                        self.warnings.append(
+                            f"Dangling target_flow '{step.target_flow}' in {where}")
+
+    def get(self, flow_id):
+        if not flow_id:
+            return None
+        return self.flows.get(flow_id)
+
+
+def load_numpy():
+    """numpy when it is installed, else None (batch scoring then loops in Python)."""
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+class SurveyScorer:
+    """A flow's web_survey compiled into an option -> axis score matrix.
+
+    Each option scores `score_key: 1` or a `scores: {axis: points}` map,
+    multiplied by the question's optional `weight`. `results.logic` picks
+    the profile from the axis totals:
+
+    - majority_wins: the highest axis; ties go to the axis listed first
+      in `results.profiles`, as calculateResult in assessment_engine.html
+      breaks them
+    - threshold: `results.axis` against `results.bands`, a list of
+      `{min, profile}`; the highest band reached wins
+
+    Answers are `{question_id: option_index}`. `score_batch` scores many
+    responses at once, vectorized with numpy when it is installed.
+    """
+
+    LOGICS = ('majority_wins', 'threshold')
+    DEFAULT_PROFILE = "General Profile"
+
+    def __init__(self, flow_id, survey):
+        self.flow_id = flow_id
+        self.slug = survey.get('slug')
+        self.warnings = []
+        results = survey.get('results') or {}
+        self.profiles = results.get('profiles') or {}
+        self.logic = results.get('logic', 'majority_wins')
+        if self.logic not in self.LOGICS:
+            self.warnings.append(
+                f"Survey '{self.slug}' has unknown results.logic '{self.logic}', using majority_wins")
+            self.logic = 'majority_wins'
+
+        questions = survey.get('questions') or []
+        self.axes = list(self.profiles)
+        option_scores = []
+        for q_index, question in enumerate(questions):
+            weight = float(question.get('weight', 1))
+            scored = []
+            for o_index, option in enumerate(question.get('options') or []):
+                points = option.get('scores')
+                if points is None:
+                    points = {option['score_key']: 1} if option.get('score_key') else {}
+                if not points:
+                    self.warnings.append(
+                        f"Survey '{self.slug}' question {q_index + 1} option {o_index + 1} scores nothing")
+                for axis in points:
+                    if axis not in self.axes:
+                        self.axes.append(axis)
+                scored.append({axis: weight * float(value) for axis, value in points.items()})
+            option_scores.append(scored)
+
+        self.question_ids = [
+            str(question.get('id') or f"q{i + 1}")
+            for i, question in enumerate(questions)
+        ]
+        self.option_counts = [len(scored) for scored in option_scores]
+        self.offsets = []
+        self.rows = []
+        for scored in option_scores:
+            self.offsets.append(len(self.rows))
+            for points in scored:
+                self.rows.append([points.get(axis, 0.0) for axis in self.axes])
+        # row for an unanswered question
+        self.blank = len(self.rows)
+        self.rows.append([0.0] * len(self.axes))
+        self._layout = tuple(zip(self.question_ids, self.offsets,
+                                 self.option_counts))
+
+        self.threshold_axis = results.get('axis') or (self.axes[0] if self.axes else None)
+        self.bands = sorted(results.get('bands') or [],
+                            key=lambda band: band.get('min', 0),
+                            reverse=True)
+        if self.logic == 'threshold' and not self.bands:
+            self.warnings.append(f"Survey '{self.slug}' uses threshold logic without bands")
+
+    def choice_rows(self, answers):
+        """Matrix row per question for one response; unknown answers score nothing."""
+        answers = answers or {}
+        rows = []
+        for question_id, offset, count in self._layout:
+            choice = answers.get(question_id)
+            if type(choice) is not int:
+                try:
+                    choice = int(choice)
+                except (TypeError, ValueError):
+                    choice = -1
+            rows.append(offset + choice if 0 <= choice < count else self.blank)
+        return rows
+
+    def profile_for(self, totals):
+        if self.logic == 'threshold':
+            if self.threshold_axis not in self.axes:
+                return self.DEFAULT_PROFILE
+            value = totals[self.axes.index(self.threshold_axis)]
+            for band in self.bands:
+                if value >= band.get('min', 0):
+                    return band.get('profile', self.DEFAULT_PROFILE)
+            return self.bands[-1].get('profile', self.DEFAULT_PROFILE) if self.bands else self.DEFAULT_PROFILE
+        if not self.axes:
+            return self.DEFAULT_PROFILE
+        best = max(range(len(self.axes)), key=lambda i: (totals[i], -i))
+        return self.profiles.get(self.axes[best], self.DEFAULT_PROFILE)
+
+    def _result(self, totals):
+        return {
+            'profile': self.profile_for(totals),
+            'scores': {axis: float(total) for axis, total in zip(self.axes, totals)}
+        }
+
+    def score(self, answers):
+        """{'profile': ..., 'scores': {axis: total}} for one response."""
+        rows = [self.rows[i] for i in self.choice_rows(answers)]
+        totals = [sum(column) for column in zip(*rows)] if rows else [0.0] * len(self.axes)
+        return self._result(totals)
+
+    def score_batch(self, responses):
+        """score() for a list of answer dicts, one matrix gather-and-sum for all."""
+        if not responses:
+            return []
+        choices = [self.choice_rows(answers) for answers in responses]
+        np = load_numpy() if self.question_ids and self.axes else None
+        if np is None:
+            totals = [[sum(column) for column in zip(*(self.rows[i] for i in rows))]
+                      if rows else [0.0] * len(self.axes) for rows in choices]
+            profiles = [self.profile_for(row) for row in totals]
+        else:
+            matrix = np.asarray(self.rows)[np.asarray(choices)].sum(axis=1)
+            profiles = self._profiles_for_matrix(np, matrix)
+            totals = matrix.tolist()
+        axes = self.axes
+        return [{
+            'profile': profile,
+            'scores': dict(zip(axes, row))
+        } for profile, row in zip(profiles, totals)]
+
+    def _profiles_for_matrix(self, np, matrix):
+        if self.logic == 'threshold':
+            if self.threshold_axis not in self.axes or not self.bands:
+                return [self.DEFAULT_PROFILE] * len(matrix)
+            values = matrix[:, self.axes.index(self.threshold_axis)]
+            labels = [band.get('profile', self.DEFAULT_PROFILE) for band in self.bands]
+            picked = np.full(len(matrix), len(labels) - 1)
+            # lowest band first, so the highest band reached is written last
+            for index in range(len(self.bands) - 1, -1, -1):
+                picked[values >= self.bands[index].get('min', 0)] = index
+        else:
+            labels = [self.profiles.get(axis, self.DEFAULT_PROFILE) for axis in self.axes]
+            # argmax returns the first maximum, matching profile_for's tie-break
+            picked = matrix.argmax(axis=1)
+        return [labels[index] for index in picked.tolist()]
+
+
+def build_survey_scorers(flows):
+    """slug -> SurveyScorer for every flow with a web_survey, plus warnings."""
+    scorers = {}
+    warnings = []
+    for flow_id, flow_data in flows.items():
+        survey = flow_data.get('web_survey')
+        if not survey or not survey.get('slug'):
+            continue
+        scorer = SurveyScorer(flow_id, survey)
+        if scorer.slug in scorers:
+            warnings.append(
+                f"Survey slug '{scorer.slug}' in '{flow_id}' shadows '{scorers[scorer.slug].flow_id}'")
+            continue
+        scorers[scorer.slug] = scorer
+        warnings.extend(scorer.warnings)
+    return scorers, warnings
+
+
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+class FlowBuildCache:
+    """Parsed-and-validated YAML modules pickled under `FLOW_CACHE_DIR`.
+
+    An entry is reused when the file's mtime and size still match, or when
+    they changed but the content hash did not (e.g. after a checkout). The
+    schema hash is part of the key, so editing flow_schema.json rebuilds
+    every module. Only valid modules are stored; the directory is a local
+    build artifact and must not be shared with untrusted writers. If the
+    directory cannot be created the cache is off and every load compiles.
+    """
+
+    FORMAT = 1
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        if directory:
+            try:
+                os.makedirs(directory, exist_ok=True)
+            except OSError as e:
+                print(f"Flow build cache disabled, cannot create {directory}: {e}")
+                self.directory = None
+
+    def _entry_path(self, file_path):
+        name = hashlib.sha1(os.path.abspath(file_path).encode()).hexdigest()
+        return os.path.join(self.directory, f"{name[:16]}.pickle")
+
+    def load(self, file_path, stat, read_source, schema_hash):
+        """Cached module data, or (None, source bytes) on a miss."""
+        if not self.directory:
+            return None, read_source()
+        source = None
         try:
-            supabase.table('events').insert({
-                'user_id':
-                user_id,
-                'category':
-                category,
-                'content':
-                content,
-                'conversation_ref':
-                conversation_ref
-            }).execute()
+            with open(self._entry_path(file_path), 'rb') as f:
+                entry = pickle.load(f)
+            if entry['format'] == self.FORMAT and entry['schema'] == schema_hash:
+                if entry['stat'] == stat:
+                    self.hits += 1
+                    return entry, None
+                source = read_source()
+                if entry['sha256'] == hashlib.sha256(source).hexdigest():
+                    self.hits += 1
+                    self.store(file_path, stat, source, schema_hash, entry['data'])
+                    return entry, None
+        except FileNotFoundError:
+            pass
         except Exception as e:
-            print(f"Event logging error: {e}")
+            print(f"Ignoring unreadable flow cache entry for {file_path}: {e}")
+        self.misses += 1
+        return None, source if source is not None else read_source()
+
+    def store(self, file_path, stat, source, schema_hash, data):
+        if not self.directory:
+            return
+        entry = {
+            'format': self.FORMAT,
+            'schema': schema_hash,
+            'stat': stat,
+            'sha256': hashlib.sha256(source).hexdigest(),
+            'data': data
+        }
+        path = self._entry_path(file_path)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            print(f"Could not write flow cache for {file_path}: {e}")
+
+
+class FlowSnapshot:
+    """One compiled, read-only view of config.yaml plus flows/*.yaml.
+
+    DataManager publishes a new snapshot per reload with a single reference
+    swap. A request pins the snapshot it started with (RequestSession
+    .snapshot), so a reload never changes flows under a conversation that
+    is mid-way through its steps. Nothing may mutate a published snapshot.
+    """
+
+    def __init__(self, master_data=None, version=0, module_times=None):
+        master_data = master_data or {}
+        self.version = version
+        self.loaded_at = time.time()
+        self.module_times = module_times or {}
+        self.config = master_data.get('config', {})
+        self.flows = master_data.get('flows', {})
+        self.symptoms = master_data.get('symptoms', {})
+        self.slots_def = master_data.get('slots', {})
+        self.system_prompts = master_data.get('system_prompts', {})
+        self.raw_config = master_data
+        self.trigger_index = TriggerIndex(self.flows)
+        self.graph = FlowGraph(self.flows)
+        self.scorers, survey_warnings = build_survey_scorers(self.flows)
+        self.surveys = {
+            slug: self.flows[scorer.flow_id]['web_survey']
+            for slug, scorer in self.scorers.items()
+        }
+        self.warnings = (self.trigger_index.warnings + self.graph.warnings +
+                         survey_warnings)
+
+    def get_system_prompt(self, key='default'):
+        return self.system_prompts.get(key, "You are Neuvero Pulse.")
+
+    def get_flow(self, flow_id):
+        flow_data = self.flows.get(flow_id)
+        if flow_data:
+            return {'flow_id': flow_id, **flow_data}
+        return None
+
+    def get_steps_for_flow(self, flow_id):
+        flow = self.flows.get(flow_id, {})
+        return flow.get('steps', [])
+
+    def find_trigger_flow(self, user_text):
+        flow_id = self.trigger_index.match(user_text)
+        if flow_id is None:
+            return None
+        return {'flow_id': flow_id, **self.flows[flow_id]}
+
+    def get_symptoms_list(self):
+        return [{
+            'symptom_name': data.get('name', key),
+            'keywords': data.get('keywords', ''),
+            'description': data.get('description', '')
+        } for key, data in self.symptoms.items()]
 
 
 class DataManager:
+    """Loads the YAML modules and publishes them as FlowSnapshots.
+
+    Parsed modules are kept per file with their (mtime, size) signature, so
+    a reload only re-parses and re-validates files that changed. Attribute
+    reads (`db.config`, `db.graph`, `db.find_trigger_flow`, ...) go to the
+    current snapshot; code that must stay consistent across several reads
+    should take `db.current()` once and use that.
+    """
 
     def __init__(self, config_path='data/config.yaml', flows_dir='flows/', schema_path='flow_schema.json'):
+        self._snapshot = FlowSnapshot()
+        self._modules = {}
+        self._reload_lock = threading.Lock()
         self.config_path = config_path
         self.flows_dir = flows_dir
         self.schema_path = schema_path
         self.schema = None
-        self.config = {}
-        self.flows = {}
-        self.symptoms = {}
-        self.slots_def = {}
-        self.system_prompts = {}
-        self.raw_config = {}
+        self.validator = None
+        self.schema_hash = None
+        self.build_cache = FlowBuildCache(FLOW_CACHE_DIR)
         self.load_schema()
         self.refresh_data()
 
+    def __getattr__(self, name):
+        return getattr(self._snapshot, name)
+
+    def current(self):
+        return self._snapshot
+
     def load_schema(self):
         try:
-            with open(self.schema_path, 'r') as f:
-                self.schema = json.load(f)
+            with open(self.schema_path, 'rb') as f:
+                schema_source = f.read()
+            self.schema = json.loads(schema_source)
+            self.schema_hash = hashlib.sha256(schema_source).hexdigest()
             print(f"Loaded validation schema from {self.schema_path}")
         except FileNotFoundError:
             print(f"Warning: Schema file not found: {self.schema_path}")
         except Exception as e:
             print(f"Warning: Could not load schema: {e}")
 
+    def compiled_validator(self):
+        """Validator for the schema, compiled on the first build-cache miss."""
+        if self.validator is None and self.schema:
+            from jsonschema import validators, SchemaError
+            try:
+                validator_cls = validators.validator_for(self.schema)
+                validator_cls.check_schema(self.schema)
+                self.validator = validator_cls(self.schema)
+            except SchemaError as e:
+                print(f"Warning: Invalid schema {self.schema_path}: {e.message}")
+                self.schema = None
+        return self.validator
+
     def validate_flow_module(self, module_data, file_path):
-        if not self.schema or not module_data:
+        validator = self.compiled_validator()
+        if not validator or not module_data:
             return True
+        errors = sorted(validator.iter_errors(module_data),
+                        key=lambda e: [str(p) for p in e.absolute_path])
+        for error in errors:
+            location = '.'.join(str(p) for p in error.absolute_path) or '(root)'
+            print(f"Warning: {file_path}: {location}: {error.message}")
+        if errors:
+            return False
+        print(f"Validated: {file_path}")
+        return True
+
+    def source_files(self):
+        flow_files = sorted(glob.glob(os.path.join(self.flows_dir, '*.yaml')))
+        return [self.config_path] + flow_files
+
+    @staticmethod
+    def file_signature(path):
         try:
-            if 'flows' in module_data:
-                for flow_id, flow_body in module_data['flows'].items():
-                    if 'steps' in flow_body:
-                        for step in flow_body['steps']:
-                            step_type = step.get('type')
-                            if step_type not in ['response', 'collect', 'action', 'branch', 'validate', 'schedule']:
-                                print(f"Warning: Invalid step type '{step_type}' in flow '{flow_id}' ({file_path})")
-                                return False
-            print(f"Validated: {file_path}")
-            return True
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def source_signature(self):
+        return {path: self.file_signature(path) for path in self.source_files()}
+
+    def load_module(self, file_path, reloaded, validate=True):
+        """Parsed contents of one YAML file, re-parsed only if it changed.
+
+        A file that fails to parse or validate after a previous good load
+        keeps serving the previous version until it is fixed.
+        """
+        signature = self.file_signature(file_path)
+        cached = self._modules.get(file_path)
+        if cached and cached[0] == signature:
+            return cached[1]
+
+        started = time.perf_counter()
+        module_data = None
+        schema_hash = self.schema_hash if validate else None
+
+        def read_source():
+            with open(file_path, 'rb') as f:
+                return f.read()
+
+        try:
+            entry, source = self.build_cache.load(file_path, signature,
+                                                  read_source, schema_hash)
+            if entry:
+                module_data = entry['data']
+            else:
+                module_data = yaml.load(source, Loader=YAML_LOADER)
+                if validate and module_data and not self.validate_flow_module(module_data, file_path):
+                    print(f"Skipping invalid module: {file_path}")
+                    module_data = None
+                    if cached and cached[1]:
+                        print(f"Keeping previous version of {file_path}")
+                        module_data = cached[1]
+                else:
+                    self.build_cache.store(file_path, signature, source,
+                                           schema_hash, module_data)
         except Exception as e:
-            print(f"Validation error for {file_path}: {e}")
-            return False
+            print(f"Error loading module {file_path}: {e}")
+            if cached and cached[1]:
+                print(f"Keeping previous version of {file_path}")
+                module_data = cached[1]
+
+        reloaded[file_path] = round((time.perf_counter() - started) * 1000, 2)
+        if self.file_signature(file_path) != signature:
+            signature = None  # written to while we read it; parse again next time
+        self._modules[file_path] = (signature, module_data)
+        return module_data
 
     def refresh_data(self):
+        with self._reload_lock:
+            return self._rebuild()
+
+    def _rebuild(self):
+        started = time.perf_counter()
+        cache_hits = self.build_cache.hits
+        reloaded = {}
         master_data = {
             'flows': {},
             'system_prompts': {},
@@ -336,105 +2522,489 @@ class DataManager:
         }
 
         if os.path.exists(self.config_path):
-            print(f"Loading base config from: {self.config_path}")
-            try:
-                with open(self.config_path, 'r') as f:
-                    config_content = yaml.safe_load(f) or {}
-                for key in ['config', 'system_prompts', 'symptoms', 'slots']:
-                    if key in config_content:
-                        master_data[key].update(config_content[key])
-            except Exception as e:
-                print(f"Error loading config: {e}")
+            config_content = self.load_module(self.config_path, reloaded, validate=False) or {}
+            for key in ['config', 'system_prompts', 'symptoms', 'slots']:
+                if key in config_content:
+                    master_data[key].update(config_content[key])
+            if 'profile_insights' in config_content:
+                master_data['config']['profile_insights'] = config_content['profile_insights']
         else:
             print(f"Warning: Config file not found at {self.config_path}")
 
-        flow_files = glob.glob(os.path.join(self.flows_dir, '*.yaml'))
-        print(f"Loading {len(flow_files)} flow modules from: {self.flows_dir}")
-        
+        flow_files = self.source_files()[1:]
         for file_path in flow_files:
-            try:
-                with open(file_path, 'r') as f:
-                    module_data = yaml.safe_load(f)
-                    
-                    if not module_data:
-                        continue
-
-                    if not self.validate_flow_module(module_data, file_path):
-                        print(f"Skipping invalid module: {file_path}")
-                        continue
-
-                    if 'flows' in module_data:
-                        for flow_id, flow_body in module_data['flows'].items():
-                            if flow_id in master_data['flows']:
-                                print(f"Warning: Duplicate flow ID '{flow_id}' in {file_path}. Overwriting.")
-                            master_data['flows'][flow_id] = flow_body
-                    
-                    if 'campaigns' in module_data:
-                        if 'campaigns' not in master_data:
-                            master_data['campaigns'] = {}
-                        master_data['campaigns'].update(module_data['campaigns'])
-                    
-                    if 'final_advice' in module_data:
-                        if 'final_advice' not in master_data:
-                            master_data['final_advice'] = {}
-                        master_data['final_advice'].update(module_data['final_advice'])
+            module_data = self.load_module(file_path, reloaded)
+            if not module_data:
+                continue
 
+            if 'flows' in module_data:
+                for flow_id, flow_body in module_data['flows'].items():
+                    if flow_id in master_data['flows']:
+                        print(f"Warning: Duplicate flow ID '{flow_id}' in {file_path}. Overwriting.")
+                    master_data['flows'][flow_id] = flow_body
+
+            if 'campaigns' in module_data:
+                if 'campaigns' not in master_data:
+                    master_data['campaigns'] = {}
+                master_data['campaigns'].update(module_data['campaigns'])
+
+            if 'final_advice' in module_data:
+                if 'final_advice' not in master_data:
+                    master_data['final_advice'] = {}
+                master_data['final_advice'].update(module_data['final_advice'])
+
+        live_files = set(flow_files) | {self.config_path}
+        for file_path in list(self._modules):
+            if file_path not in live_files:
+                del self._modules[file_path]
+
+        snapshot = FlowSnapshot(master_data,
+                                version=self._snapshot.version + 1,
+                                module_times=reloaded)
+        for warning in snapshot.warnings:
+            print(f"Warning: {warning}")
+        self._snapshot = snapshot
+
+        for file_path, ms in reloaded.items():
+            print(f"Reloaded {file_path} in {ms}ms")
+        total_steps = sum(len(f.get('steps', [])) for f in snapshot.flows.values())
+        elapsed = round((time.perf_counter() - started) * 1000, 2)
+        print(f"System Loaded: {len(snapshot.flows)} flows, {total_steps} steps, {len(snapshot.symptoms)} symptoms, {len(snapshot.slots_def)} slots "
+              f"(snapshot v{snapshot.version}, {len(reloaded)}/{len(flow_files) + 1} modules reloaded, "
+              f"{self.build_cache.hits - cache_hits} from build cache, {elapsed}ms).")
+        return snapshot
+
+
+class FlowWatcher:
+    """Polls the YAML sources and reloads `db` when any of them changes.
+
+    A change is only picked up once it has been stable for one interval,
+    so an editor that is still writing a file is not reloaded half-way.
+    """
+
+    def __init__(self, manager, interval):
+        self.manager = manager
+        self.interval = interval
+        self.reloads = 0
+        self._last = None
+        self._thread = None
+
+    def start(self):
+        if self._thread or self.interval <= 0:
+            return
+        self._last = self.manager.source_signature()
+        self._thread = threading.Thread(target=self._run,
+                                        name='flow-watcher',
+                                        daemon=True)
+        self._thread.start()
+        print(f"Watching flow modules every {self.interval}s")
+
+    def _run(self):
+        last = self._last
+        pending = None
+        while True:
+            time.sleep(self.interval)
+            try:
+                current = self.manager.source_signature()
+                if current == last:
+                    pending = None
+                elif current != pending:
+                    pending = current
+                else:
+                    last, pending = current, None
+                    self.manager.refresh_data()
+                    self.reloads += 1
             except Exception as e:
-                print(f"Error loading module {file_path}: {e}")
+                print(f"Flow watcher error: {e}")
 
-        self.config = master_data['config']
-        self.flows = master_data['flows']
-        self.symptoms = master_data['symptoms']
-        self.slots_def = master_data['slots']
-        self.system_prompts = master_data['system_prompts']
-        self.raw_config = master_data
 
-        total_steps = sum(len(f.get('steps', [])) for f in self.flows.values())
-        print(f"System Loaded: {len(self.flows)} flows, {total_steps} steps, {len(self.symptoms)} symptoms, {len(self.slots_def)} slots.")
+config_started = time.perf_counter()
+db = DataManager()
+record_startup_phase('config', config_started)
+flow_watcher = FlowWatcher(db, FLOW_WATCH_INTERVAL)
 
-    def get_system_prompt(self, key='default'):
-        return self.system_prompts.get(key, "You are Neuvero Pulse.")
 
-    def get_flow(self, flow_id):
-        flow_data = self.flows.get(flow_id)
-        if flow_data:
-            return {'flow_id': flow_id, **flow_data}
+def build_gemini_model():
+    if not GEMINI_API_KEY:
+        print("Warning: Gemini AI not connected.")
         return None
+    import google.generativeai as genai
+    genai.configure(api_key=GEMINI_API_KEY)
+    system_prompt = db.get_system_prompt('default')
+    model = genai.GenerativeModel('gemini-2.0-flash-exp',
+                                  system_instruction=system_prompt)
+    print("Gemini AI connected with Neuvero Pulse system prompt.")
+    return model
+
+
+get_gemini_model = LazyClient('gemini', build_gemini_model)
+
+
+class LLMExecutor:
+    """Runs Gemini calls on a bounded thread pool with a per-action deadline.
+
+    `generate` returns the model text, or None when the model is missing,
+    the call fails, the deadline passes or the pool is saturated, so the
+    caller can fall back immediately. A call that finishes after its
+    deadline is still timed and its text handed to `on_late`.
+
+    With `async_calls`, requests go through the model's
+    `generate_content_async` on one event-loop thread instead of holding a
+    pool thread each, so only `max_pending` limits how many are in flight.
+    """
+
+    def __init__(self, max_workers=4, max_pending=16, cache=None,
+                 async_calls=False):
+        self._pool = ThreadPoolExecutor(max_workers=max_workers,
+                                        thread_name_prefix='llm')
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._event_loop = None
+        self.cache = cache
+        self.async_calls = async_calls
+
+    def _loop(self):
+        with self._lock:
+            if self._event_loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever,
+                                 name='llm-async',
+                                 daemon=True).start()
+                self._event_loop = loop
+            return self._event_loop
+
+    def _submit(self, model, prompt):
+        if self.async_calls and hasattr(model, 'generate_content_async'):
+            return asyncio.run_coroutine_threadsafe(
+                model.generate_content_async(prompt), self._loop())
+        return self._pool.submit(model.generate_content, prompt)
+
+    def _record(self, action_name, outcome, latency_ms=None):
+        with self._lock:
+            stats = self._stats.setdefault(
+                action_name, {
+                    'calls': 0,
+                    'ok': 0,
+                    'errors': 0,
+                    'timeouts': 0,
+                    'rejected': 0,
+                    'late_results': 0,
+                    'cache_hits': 0,
+                    'total_ms': 0.0,
+                    'max_ms': 0.0
+                })
+            stats[outcome] += 1
+            if latency_ms is not None:
+                stats['calls'] += 1
+                stats['total_ms'] += latency_ms
+                stats['max_ms'] = max(stats['max_ms'], latency_ms)
+
+    def generate(self,
+                 action_name,
+                 prompt,
+                 timeout,
+                 on_late=None,
+                 cache_variants=0,
+                 accept=None):
+        model = get_gemini_model()
+        if not model:
+            return None
 
-    def get_steps_for_flow(self, flow_id):
-        flow = self.flows.get(flow_id, {})
-        return flow.get('steps', [])
+        cache = self.cache if cache_variants else None
+        if cache:
+            cached = cache.get(action_name, prompt, cache_variants)
+            if cached is not None:
+                self._record(action_name, 'cache_hits')
+                return cached
+
+        def store(text):
+            if cache and text and (accept is None or accept(text)):
+                cache.put(action_name, prompt, text, cache_variants)
+            return text
+
+        if not self._slots.acquire(blocking=False):
+            self._record(action_name, 'rejected')
+            print(f"LLM pool saturated, skipping {action_name}")
+            return None
 
-    def find_trigger_flow(self, user_text):
-        text = user_text.upper()
-        for flow_id, flow_data in self.flows.items():
-            triggers = flow_data.get('triggers', [])
-            if isinstance(triggers, str):
-                triggers = [
-                    t.strip() for t in triggers.split(',') if t.strip()
-                ]
-            for trigger in triggers:
-                if trigger.upper() in text:
-                    return {'flow_id': flow_id, **flow_data}
-        return None
+        state = {'late': False, 'done': False}
+        started = time.monotonic()
+
+        def finished(future):
+            self._slots.release()
+            latency_ms = (time.monotonic() - started) * 1000
+            error = future.exception()
+            with self._lock:
+                state['done'] = True
+                late = state['late']
+            if error is not None:
+                self._record(action_name, 'errors', latency_ms)
+                return
+            self._record(action_name, 'late_results' if late else 'ok',
+                         latency_ms)
+            if late:
+                try:
+                    text = store(future.result().text)
+                    if on_late:
+                        on_late(text)
+                except Exception as e:
+                    print(f"Late {action_name} result dropped: {e}")
 
-    def get_symptoms_list(self):
-        return [{
-            'symptom_name': data.get('name', key),
-            'keywords': data.get('keywords', ''),
-            'description': data.get('description', '')
-        } for key, data in self.symptoms.items()]
+        try:
+            future = self._submit(model, prompt)
+        except RuntimeError as e:
+            self._slots.release()
+            print(f"LLM pool unavailable: {e}")
+            return None
+        future.add_done_callback(finished)
 
+        try:
+            return store(future.result(timeout=timeout).text)
+        except FuturesTimeout:
+            with self._lock:
+                state['late'] = not state['done']
+            if state['late']:
+                self._record(action_name, 'timeouts')
+                print(f"{action_name} exceeded {timeout}s deadline, using fallback")
+                return None
+            return store(future.result().text)
+        except Exception as e:
+            print(f"Gemini Error ({action_name}): {e}")
+            return None
 
-db = DataManager()
+    def stats(self):
+        with self._lock:
+            out = {}
+            for action_name, stats in self._stats.items():
+                out[action_name] = dict(stats)
+                out[action_name]['total_ms'] = round(stats['total_ms'], 1)
+                out[action_name]['max_ms'] = round(stats['max_ms'], 1)
+                out[action_name]['avg_ms'] = round(
+                    stats['total_ms'] / stats['calls'], 1) if stats['calls'] else 0.0
+            return out
+
+
+class LLMResponseCache:
+    """Content-addressed cache of Gemini responses, in memory and in SQLite.
+
+    Keys hash the action name with the whitespace-normalized prompt. Each
+    key holds up to `variants` responses: until that many are stored a
+    lookup misses, so the model is asked again and its answer is kept as
+    another variant; after that a stored variant is sampled at random.
+    SQLite is shared by the workers, so a key that is still short of its
+    variants is not held in memory, and a store merges with what the
+    others wrote.
+
+    The SQLite connection is opened on first use in each process: one
+    opened in the gunicorn master under `--preload` must not be shared by
+    the forked workers.
+    """
+
+    def __init__(self,
+                 path=None,
+                 ttl_seconds=86400,
+                 max_entries=5000,
+                 memory_entries=500):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.memory_entries = memory_entries
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        self._conn_pid = None
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.stores = 0
+        self.evictions = 0
+
+    def _connection(self):
+        """This process's connection (None when memory-only); call under _lock."""
+        if self._conn_pid == os.getpid():
+            return self._conn
+        self._conn_pid = os.getpid()
+        self._conn = None
+        if self.path:
+            try:
+                conn = sqlite3.connect(self.path, check_same_thread=False)
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.execute(
+                    'CREATE TABLE IF NOT EXISTS llm_cache ('
+                    'key TEXT NOT NULL, variant INTEGER NOT NULL, '
+                    'response TEXT NOT NULL, created_at REAL NOT NULL, '
+                    'PRIMARY KEY (key, variant))')
+                conn.commit()
+                self._conn = conn
+            except Exception as e:
+                print(f"Warning: LLM cache running memory-only: {e}")
+        return self._conn
 
-if GEMINI_API_KEY:
-    system_prompt = db.get_system_prompt('default')
-    gemini_model = genai.GenerativeModel('gemini-2.0-flash-exp',
-                                         system_instruction=system_prompt)
-    print("Gemini AI connected with Neuvero Pulse system prompt.")
-else:
-    print("Warning: Gemini AI not connected.")
+    @staticmethod
+    def key(action_name, prompt):
+        normalized = " ".join(prompt.split())
+        return hashlib.sha256(
+            f"{action_name}\n{normalized}".encode('utf-8')).hexdigest()
+
+    def _fresh(self, variants, now):
+        return [v for v in variants if now - v[0] <= self.ttl_seconds]
+
+    def _load(self, key, now):
+        conn = self._connection()
+        if not conn:
+            return []
+        rows = conn.execute(
+            'SELECT created_at, response FROM llm_cache '
+            'WHERE key = ? AND created_at >= ? ORDER BY variant',
+            (key, now - self.ttl_seconds)).fetchall()
+        return [(created_at, response) for created_at, response in rows]
+
+    def _remember(self, key, variants):
+        self._memory[key] = variants
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _keep(self, key, stored, variants, conn):
+        """Memory only holds complete entries: a short one is read from
+        SQLite again next time, where other workers may have added to it.
+        Without SQLite memory is the only layer and keeps everything."""
+        if len(stored) >= variants or not conn:
+            self._remember(key, stored)
+        else:
+            self._memory.pop(key, None)
+
+    def get(self, action_name, prompt, variants=1):
+        key = self.key(action_name, prompt)
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            stored = self._fresh(self._memory.get(key, []), now)
+            if len(stored) < variants and conn:
+                try:
+                    stored = self._load(key, now)
+                except Exception as e:
+                    print(f"LLM cache read error: {e}")
+                    stored = []
+                if stored:
+                    self.disk_hits += 1
+            self._keep(key, stored, variants, conn)
+            if len(stored) < variants:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return random.choice(stored)[1]
+
+    def put(self, action_name, prompt, text, variants=1):
+        """Add `text` as a variant, keeping the newest `variants` of them.
+
+        The stored variants are re-read inside a write transaction, so
+        variants other processes added meanwhile are merged, not replaced.
+        """
+        key = self.key(action_name, prompt)
+        now = time.time()
+        keep = max(1, variants)
+        with self._lock:
+            conn = self._connection()
+            stored = (self._fresh(self._memory.get(key, []), now) +
+                      [(now, text)])[-keep:]
+            if conn:
+                try:
+                    conn.execute('BEGIN IMMEDIATE')
+                    stored = (self._load(key, now) + [(now, text)])[-keep:]
+                    conn.execute('DELETE FROM llm_cache WHERE key = ?', (key, ))
+                    conn.executemany(
+                        'INSERT INTO llm_cache (key, variant, response, created_at) '
+                        'VALUES (?, ?, ?, ?)',
+                        [(key, i, response, created_at)
+                         for i, (created_at, response) in enumerate(stored)])
+                    self._writes += 1
+                    if self._writes % 100 == 0:
+                        self._prune(conn, now)
+                    conn.commit()
+                except Exception as e:
+                    conn.rollback()
+                    print(f"LLM cache write error: {e}")
+            self._keep(key, stored, variants, conn)
+            self.stores += 1
+
+    def _prune(self, conn, now):
+        conn.execute('DELETE FROM llm_cache WHERE created_at < ?',
+                     (now - self.ttl_seconds, ))
+        count = conn.execute('SELECT COUNT(*) FROM llm_cache').fetchone()[0]
+        overflow = count - self.max_entries
+        if overflow > 0:
+            conn.execute(
+                'DELETE FROM llm_cache WHERE rowid IN ('
+                'SELECT rowid FROM llm_cache ORDER BY created_at LIMIT ?)',
+                (overflow, ))
+            self.evictions += overflow
+
+    def stats(self):
+        with self._lock:
+            return {
+                'memory_keys': len(self._memory),
+                'persistent': self._connection() is not None,
+                'hits': self.hits,
+                'misses': self.misses,
+                'disk_hits': self.disk_hits,
+                'stores': self.stores,
+                'evictions': self.evictions
+            }
+
+
+# Executor sizes and the cache are fixed at startup; /refresh does not
+# rebuild them. Deadlines and cache variants are read per turn from the
+# session's snapshot.
+llm_config = db.config.get('llm', {})
+llm_cache_config = llm_config.get('cache', {})
+llm_cache = None
+if llm_cache_config.get('enabled'):
+    llm_cache = LLMResponseCache(
+        path=LLM_CACHE_PATH or None,
+        ttl_seconds=llm_cache_config.get('ttl_seconds', 86400),
+        max_entries=llm_cache_config.get('max_entries', 5000),
+        memory_entries=llm_cache_config.get('memory_entries', 500))
+llm_executor = LLMExecutor(max_workers=llm_config.get('max_workers', 4),
+                           max_pending=llm_config.get('max_pending', 16),
+                           cache=llm_cache,
+                           async_calls=llm_config.get('async_calls', False))
+
+
+def llm_timeout(data, action_name):
+    config = data.config.get('llm', {})
+    return config.get('action_timeouts', {}).get(
+        action_name, config.get('default_timeout_seconds', 8))
+
+
+def llm_cache_variants(data, action_name):
+    return data.config.get('llm', {}).get('cache', {}).get('variants', {}).get(
+        action_name, 1)
+
+
+def parse_stress_analysis(text):
+    cleaned_text = text.strip().replace('```json', '').replace('```', '')
+    return json.loads(cleaned_text)
+
+
+def is_stress_analysis(text):
+    try:
+        return isinstance(parse_stress_analysis(text), dict)
+    except ValueError:
+        return False
+
+
+def record_late_llm_result(action_name, user_id):
+
+    def on_late(text):
+        ConversationLogger.log_event(
+            user_id=user_id,
+            category='System',
+            content=f"Late {action_name} result: {text}")
+
+    return on_late
 
 
 class ActionEngine:
@@ -444,6 +3014,7 @@ class ActionEngine:
         print(f"Executing Action: {action_name}")
         slots = session['slots']
         user_id = session.get('user_id')
+        data = session.snapshot
 
         action_name = action_name.strip()
 
@@ -453,7 +3024,7 @@ class ActionEngine:
 
             kb_text = "\n".join([
                 f"- {s.get('symptom_name','Pattern')}: {s.get('keywords','')}"
-                for s in db.get_symptoms_list()
+                for s in data.get_symptoms_list()
             ])
 
             prompt = f"""
@@ -469,18 +3040,24 @@ class ActionEngine:
             Return ONLY JSON format: {{ "pattern": "Pattern Name", "category": "NORMAL" or "EMERGENCY" }}
             """
 
+            if not get_gemini_model():
+                slots['ai_analysis'] = {
+                    "category": "NORMAL",
+                    "pattern": "Test Mode"
+                }
+                return None
+
             try:
-                if gemini_model:
-                    response = gemini_model.generate_content(prompt)
-                    cleaned_text = response.text.strip().replace(
-                        '```json', '').replace('```', '')
-                    analysis = json.loads(cleaned_text)
-                    slots['ai_analysis'] = analysis
-                else:
-                    slots['ai_analysis'] = {
-                        "category": "NORMAL",
-                        "pattern": "Test Mode"
-                    }
+                text = llm_executor.generate(
+                    action_name,
+                    prompt,
+                    timeout=llm_timeout(data, action_name),
+                    on_late=record_late_llm_result(action_name, user_id),
+                    cache_variants=llm_cache_variants(data, action_name),
+                    accept=is_stress_analysis)
+                if text is None:
+                    raise ValueError("no analysis before deadline")
+                slots['ai_analysis'] = parse_stress_analysis(text)
             except Exception as e:
                 print(f"Gemini Error: {e}")
                 slots['ai_analysis'] = {
@@ -492,7 +3069,7 @@ class ActionEngine:
         elif action_name == 'generate_final_advice':
             profile_type = slots.get('calculated_profile', 'Unknown')
             
-            final_advice_config = db.raw_config.get('final_advice', {})
+            final_advice_config = data.raw_config.get('final_advice', {})
             advice = final_advice_config.get(profile_type, 
                 final_advice_config.get('default', 
                     "Focus on one small experiment this week to test your leadership edge."))
@@ -536,21 +3113,27 @@ class ActionEngine:
             profile_type = slots.get('calculated_profile', 'Unknown')
             first_name = slots.get('first_name', 'Leader')
             
-            profile_config = db.config.get('profile_insights', {})
+            profile_config = data.config.get('profile_insights', {})
             fallbacks = profile_config.get('fallbacks', {})
             prompt_template = profile_config.get('prompt_template', '')
             
             insights = None
             
-            if gemini_model and prompt_template:
+            if get_gemini_model() and prompt_template:
                 try:
                     prompt = prompt_template.format(
                         first_name=first_name,
                         calculated_profile=profile_type
                     )
-                    response = gemini_model.generate_content(prompt)
-                    insights = response.text.strip()
-                    print(f"Generated dynamic insights for {profile_type}")
+                    text = llm_executor.generate(
+                        action_name,
+                        prompt,
+                        timeout=llm_timeout(data, action_name),
+                        on_late=record_late_llm_result(action_name, user_id),
+                        cache_variants=llm_cache_variants(data, action_name))
+                    if text:
+                        insights = text.strip()
+                        print(f"Generated dynamic insights for {profile_type}")
                 except Exception as e:
                     print(f"Gemini error generating insights: {e}")
             
@@ -567,89 +3150,458 @@ class ActionEngine:
         return None
 
 
-def check_guard(guard_str, user_input, slots):
-    if not guard_str:
-        return False
+class TokenBucket:
+    """Thread-safe token bucket; `acquire` blocks until a token is free.
+
+    Bulk callers (`acquire(bulk=True)`, `try_acquire`) only get a token
+    while no regular caller is waiting, so replies are never queued behind
+    a batch of scheduled sends. A rate of 0 or less disables limiting.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._cond = threading.Condition()
+        self._waiting = 0
+
+    def _refill_locked(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity,
+                           self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, bulk=False):
+        if self.rate <= 0:
+            return 0.0
+        started = time.monotonic()
+        with self._cond:
+            if not bulk:
+                self._waiting += 1
+            try:
+                while True:
+                    self._refill_locked()
+                    if self._tokens >= 1 and not (bulk and self._waiting):
+                        self._tokens -= 1
+                        return time.monotonic() - started
+                    if self._tokens >= 1:
+                        # a reply is waiting; it wakes us once it is served
+                        wait = 1 / self.rate
+                    else:
+                        wait = (1 - self._tokens) / self.rate
+                    self._cond.wait(wait)
+            finally:
+                if not bulk:
+                    self._waiting -= 1
+                    self._cond.notify_all()
+
+    def try_acquire(self, n):
+        """Take up to `n` tokens without waiting; returns how many were taken."""
+        if self.rate <= 0:
+            return n
+        with self._cond:
+            if self._waiting:
+                return 0
+            self._refill_locked()
+            taken = min(n, int(self._tokens))
+            self._tokens -= taken
+            return taken
+
+    def release(self, n=1):
+        """Give back tokens taken with `try_acquire` that were not used."""
+        if self.rate <= 0 or n <= 0:
+            return
+        with self._cond:
+            self._refill_locked()
+            self._tokens = min(self.capacity, self._tokens + n)
+            self._cond.notify_all()
+
+    def refill_seconds(self):
+        """Time for an empty bucket to fill up again."""
+        return self.capacity / self.rate if self.rate > 0 else 0.0
+
+
+sms_rate_limiter = TokenBucket(TWILIO_MAX_MPS)
+
+GSM7_BASIC = frozenset(
+    "@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞÆæßÉ !\"#¤%&'()*+,-./0123456789:;<=>?"
+    "¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà")
+GSM7_EXTENDED = frozenset("^{}\\[~]|€\f")
+
+# Lookalikes that would otherwise force the whole message into UCS-2.
+SMS_TRANSLITERATIONS = {
+    '\u2018': "'", '\u2019': "'", '\u201a': "'", '\u201b': "'",
+    '\u2032': "'", '\u201c': '"', '\u201d': '"', '\u201e': '"',
+    '\u2033': '"', '\u00ab': '"', '\u00bb': '"', '\u2013': '-',
+    '\u2014': '-', '\u2015': '-', '\u2212': '-', '\u2026': '...',
+    '\u00a0': ' ', '\u2009': ' ', '\u202f': ' ', '\u2007': ' ',
+    '\u200b': '', '\ufeff': '', '\u2022': '-', '\u00b7': '-',
+    '\t': ' '
+}
 
-    if "input !=" in guard_str:
-        target = guard_str.split("!=")[1].strip().replace("'",
-                                                          "").replace('"', "")
-        return user_input.upper() != target.upper()
+MARKDOWN_PATTERNS = (
+    (re.compile(r'\*\*(.+?)\*\*', re.S), r'\1'),
+    (re.compile(r'__(.+?)__', re.S), r'\1'),
+    (re.compile(r'(?<![\w*])\*(?=\S)([^*\n]+?)(?<=\S)\*(?![\w*])'), r'\1'),
+    (re.compile(r'`([^`\n]*)`'), r'\1'),
+    (re.compile(r'^#{1,6}[ \t]+', re.M), ''),
+    (re.compile(r'^([ \t]*)[*+][ \t]+', re.M), r'\1- '),
+    (re.compile(r'\[([^\]\n]+)\]\((\S+?)\)'), r'\1 \2'),
+)
+
+SMS_BOUNDARY = re.compile(r'(?<=[.!?])[ \t]+|\n')
+
+
+class SmsPacker:
+    """Turns reply text into the cheapest set of SMS bodies.
+
+    GSM-7 fits 160 characters in one segment (153 per part once the carrier
+    concatenates), UCS-2 only 70 (67). `pack` cleans the text, then either
+    keeps it as one message or splits it at line and sentence boundaries
+    into standalone single-segment messages, whichever bills fewer
+    segments; a tie keeps the single message to save API calls. Segment
+    counts are tallied per flow so expensive flows show up in /health.
+    """
+
+    LIMITS = {'gsm7': (160, 153), 'ucs2': (70, 67)}
+
+    def __init__(self, transliterate=True, strip_markdown=True):
+        self.transliterate = transliterate
+        self.strip_markdown = strip_markdown
+        self._lock = threading.Lock()
+        self._flows = {}
+
+    def clean(self, text):
+        if self.strip_markdown:
+            for pattern, replacement in MARKDOWN_PATTERNS:
+                text = pattern.sub(replacement, text)
+        if self.transliterate:
+            text = ''.join(SMS_TRANSLITERATIONS.get(ch, ch) for ch in text)
+        return text.strip()
 
-    if "ai_analysis.category ==" in guard_str:
-        target = guard_str.split("==")[1].strip().replace("'",
-                                                          "").replace('"', "")
-        analysis = slots.get('ai_analysis', {})
-        return analysis.get('category') == target
+    @staticmethod
+    def encoding(text):
+        if all(ch in GSM7_BASIC or ch in GSM7_EXTENDED for ch in text):
+            return 'gsm7'
+        return 'ucs2'
 
-    return False
+    @staticmethod
+    def units(text, encoding):
+        """Septets (GSM-7) or UTF-16 code units (UCS-2) the text occupies."""
+        if encoding == 'gsm7':
+            return len(text) + sum(1 for ch in text if ch in GSM7_EXTENDED)
+        return len(text.encode('utf-16-le')) // 2
+
+    def segments(self, text):
+        if not text:
+            return 0
+        encoding = self.encoding(text)
+        single, multi = self.LIMITS[encoding]
+        units = self.units(text, encoding)
+        return 1 if units <= single else -(-units // multi)
+
+    def fits(self, text):
+        return self.segments(text) <= 1
+
+    def pack(self, text, flow_id=None):
+        text = self.clean(text or '')
+        if not text:
+            return []
+        parts = [text]
+        if not self.fits(text):
+            split = self._split(text)
+            if len(split) < self.segments(text):
+                parts = split
+        self._record(flow_id, parts)
+        return parts
+
+    def _split(self, text):
+        parts = []
+        current = ''
+        for piece in self._pieces(text):
+            if not piece:
+                continue
+            candidate = f"{current}{piece}" if current else piece.lstrip()
+            if self.fits(candidate.rstrip()):
+                current = candidate
+                continue
+            if current.strip():
+                parts.append(current.strip())
+            current = piece.lstrip()
+        if current.strip():
+            parts.append(current.strip())
+        return parts
+
+    def _pieces(self, text):
+        """Sentences/lines (keeping their separators), split further by
+        words and then characters when a single one overflows a segment."""
+        start = 0
+        for match in SMS_BOUNDARY.finditer(text):
+            yield from self._fit_piece(text[start:match.end()])
+            start = match.end()
+        yield from self._fit_piece(text[start:])
+
+    def _fit_piece(self, piece):
+        if self.fits(piece.strip()):
+            yield piece
+            return
+        for word in re.split(r'(?<= )', piece):
+            while word and not self.fits(word.strip()):
+                cut = len(word) - 1
+                while cut > 1 and not self.fits(word[:cut]):
+                    cut -= 1
+                yield word[:cut]
+                word = word[cut:]
+            if word:
+                yield word
+
+    def _record(self, flow_id, parts):
+        key = flow_id or '(none)'
+        segments = sum(self.segments(part) for part in parts)
+        ucs2 = any(self.encoding(part) == 'ucs2' for part in parts)
+        with self._lock:
+            stats = self._flows.setdefault(key, {
+                'responses': 0,
+                'messages': 0,
+                'segments': 0,
+                'ucs2_responses': 0,
+                'max_segments': 0
+            })
+            stats['responses'] += 1
+            stats['messages'] += len(parts)
+            stats['segments'] += segments
+            stats['ucs2_responses'] += int(ucs2)
+            stats['max_segments'] = max(stats['max_segments'], segments)
+        print(f"SMS reply for {key}: {segments} segment(s) in "
+              f"{len(parts)} message(s){' [UCS-2]' if ucs2 else ''}")
+
+    def stats(self):
+        with self._lock:
+            flows = {
+                flow_id: {
+                    **stats, 'avg_segments':
+                    round(stats['segments'] / stats['responses'], 2)
+                }
+                for flow_id, stats in self._flows.items()
+            }
+        return {
+            'responses': sum(s['responses'] for s in flows.values()),
+            'segments': sum(s['segments'] for s in flows.values()),
+            'messages': sum(s['messages'] for s in flows.values()),
+            'flows': flows
+        }
 
 
-def send_sms(to_phone, message):
-    if twilio_client and TWILIO_PHONE_NUMBER:
-        try:
-            twilio_client.messages.create(body=message,
-                                          from_=TWILIO_PHONE_NUMBER,
-                                          to=to_phone)
-            print(f"Sent SMS to {to_phone}: {message[:50]}...")
-            return True
-        except Exception as e:
-            print(f"Error sending SMS: {e}")
-    return False
-
-
-def process_conversation(phone, user_input, is_scheduled=False):
-    session = UserManager.get_session(phone)
-    if not session:
-        session = {
-            'user_id': None,
-            'current_flow': None,
-            'step_order': 0,
-            'slots': {},
-            'pending_slot': None,
-            'timezone': 'America/New_York'
-        }
+sms_packer = SmsPacker(transliterate=SMS_TRANSLITERATE,
+                       strip_markdown=SMS_STRIP_MARKDOWN)
+
+
+class OutboundMessenger:
+    """Sends SMS over the pooled Twilio client from a small thread pool.
+
+    Messages are queued per destination and each destination is drained by
+    at most one worker at a time, so one user's messages go out in the order
+    they were submitted while different users are sent in parallel. 429s,
+    5xxs and connection failures are retried with jittered exponential
+    backoff; every attempt waits on the shared token bucket, `bulk` sends
+    behind everything else. A `prepaid` message was sent with a token its
+    caller already took, so its first attempt does not wait.
+    """
+
+    BACKOFF_BASE = 0.5
+    BACKOFF_CAP = 8.0
+
+    def __init__(self, max_workers, max_retries, rate_limiter):
+        self.max_retries = max_retries
+        self.rate_limiter = rate_limiter
+        self._executor = ThreadPoolExecutor(max_workers=max(max_workers, 1),
+                                            thread_name_prefix='sms')
+        self._lanes = {}
+        self._lock = threading.Lock()
+        self._counts = {'sent': 0, 'failed': 0, 'retries': 0}
+
+    def submit(self, to_phone, message, bulk=False, prepaid=False):
+        """Queue one message; returns a Future resolving to True/False."""
+        future = Future()
+        with self._lock:
+            lane = self._lanes.get(to_phone)
+            start = lane is None
+            if start:
+                lane = self._lanes[to_phone] = deque()
+            lane.append((message, future, bulk, prepaid))
+        if start:
+            self._executor.submit(self._drain, to_phone)
+        return future
+
+    def send_many(self, messages):
+        """Queue (to_phone, message) pairs; returns their futures in order."""
+        return [
+            self.submit(to_phone, message) for to_phone, message in messages
+        ]
+
+    def send(self, to_phone, message):
+        return self.submit(to_phone, message).result()
+
+    def _drain(self, to_phone):
+        while True:
+            with self._lock:
+                lane = self._lanes[to_phone]
+                if not lane:
+                    del self._lanes[to_phone]
+                    return
+                message, future, bulk, prepaid = lane.popleft()
+            try:
+                future.set_result(
+                    self._deliver(to_phone, message, bulk, prepaid))
+            except Exception as e:
+                print(f"Error sending SMS: {e}")
+                future.set_result(False)
+
+    @staticmethod
+    def _retryable(error):
+        if isinstance(error, TwilioRestException):
+            # no status means the request never got an HTTP answer
+            return error.status is None or error.status == 429 or \
+                error.status >= 500
+        from requests.exceptions import ConnectionError as HTTPConnectionError
+        return isinstance(error, HTTPConnectionError)
+
+    def _deliver(self, to_phone, message, bulk=False, prepaid=False):
+        attempt = 0
+        while True:
+            if attempt or not prepaid:
+                self.rate_limiter.acquire(bulk=bulk)
+            started = time.perf_counter()
+            try:
+                get_twilio().messages.create(body=message,
+                                             from_=TWILIO_PHONE_NUMBER,
+                                             to=to_phone)
+                twilio_send_seconds.observe(time.perf_counter() - started,
+                                            'sent')
+                print(f"Sent SMS to {to_phone}: {message[:50]}...")
+                self._count('sent')
+                return True
+            except Exception as e:
+                twilio_send_seconds.observe(time.perf_counter() - started,
+                                            'error')
+                if attempt >= self.max_retries or not self._retryable(e):
+                    print(f"Error sending SMS to {to_phone}: {e}")
+                    self._count('failed')
+                    return False
+                delay = random.uniform(
+                    0, min(self.BACKOFF_CAP, self.BACKOFF_BASE * 2**attempt))
+                attempt += 1
+                self._count('retries')
+                print(f"Retrying SMS to {to_phone} in {delay:.2f}s "
+                      f"(attempt {attempt}/{self.max_retries}): {e}")
+                time.sleep(delay)
+
+    def _count(self, key):
+        with self._lock:
+            self._counts[key] += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                **self._counts,
+                'queued': sum(len(lane) for lane in self._lanes.values()),
+                'active_destinations': len(self._lanes)
+            }
+
+
+outbound = OutboundMessenger(TWILIO_SEND_WORKERS, TWILIO_SEND_RETRIES,
+                             sms_rate_limiter)
+
+reply_executor = ThreadPoolExecutor(max_workers=ASYNC_REPLY_WORKERS,
+                                    thread_name_prefix='reply')
+
+
+def send_sms(to_phone, message, flow_id=None, bulk=False, prepaid=False):
+    """Send `message` in as many parts as it needs; True if all went out.
+
+    `bulk` sends (scheduled tasks) wait behind replies for their tokens.
+    With `prepaid` the caller already took a token for the first part; it
+    is given back if nothing is sent.
+    """
+    parts = []
+    if get_twilio() and TWILIO_PHONE_NUMBER:
+        parts = sms_packer.pack(message, flow_id)
+    if prepaid and not parts:
+        sms_rate_limiter.release()
+    if not parts:
+        return False
+    futures = [
+        outbound.submit(to_phone, part, bulk=bulk,
+                        prepaid=prepaid and index == 0)
+        for index, part in enumerate(parts)
+    ]
+    return all(future.result() for future in futures)
+
+
+def process_conversation(phone,
+                         user_input,
+                         is_scheduled=False,
+                         session=None,
+                         trigger_flow=None,
+                         allow_defer=False):
+    if session is None:
+        session = RequestSession.load(phone)
 
     if not is_scheduled:
-        new_flow_obj = db.find_trigger_flow(user_input)
+        new_flow_obj = trigger_flow or session.snapshot.find_trigger_flow(
+            user_input)
 
         if new_flow_obj:
             current_flow_id = session['current_flow']
-            current_flow_def = db.get_flow(
-                current_flow_id) if current_flow_id else None
-
-            is_locked = current_flow_def.get(
-                'is_locked') if current_flow_def else False
+            current_flow = session.snapshot.graph.get(current_flow_id)
+            is_locked = current_flow.is_locked if current_flow else False
 
             if not is_locked or new_flow_obj['flow_id'] == current_flow_id:
                 print(f"Switching context to {new_flow_obj['flow_id']}")
                 existing_slots = session.get('slots', {})
-                
-                new_flow_steps = db.get_steps_for_flow(new_flow_obj['flow_id'])
-                flow_slot_vars = set()
-                for step in new_flow_steps:
-                    if step.get('type') == 'collect' and step.get('variable'):
-                        flow_slot_vars.add(step.get('variable'))
-                
-                for var in flow_slot_vars:
+
+                new_flow = session.snapshot.graph.get(new_flow_obj['flow_id'])
+                for var in new_flow.collect_vars:
                     existing_slots.pop(var, None)
-                
-                session = {
-                    'user_id': session.get('user_id'),
-                    'current_flow': new_flow_obj['flow_id'],
-                    'step_order': 0,
-                    'slots': existing_slots,
-                    'pending_slot': None,
-                    'timezone': session.get('timezone', 'America/New_York')
-                }
+
+                session['current_flow'] = new_flow_obj['flow_id']
+                session['step_order'] = 0
+                session['slots'] = existing_slots
+                session['pending_slot'] = None
 
     if not session['current_flow']:
-        UserManager.save_session(phone, session)
+        session.flush()
         return "I'm listening. Text OUCH to start."
 
+    session.reply_flow = session['current_flow']
     response_buffer = []
+    status = run_steps(phone, user_input, session, response_buffer,
+                       allow_defer)
+
+    if status == 'deferred':
+        flow = session.snapshot.graph.get(session['current_flow'])
+        ack = (flow.async_reply_ack
+               if flow else None) or session.snapshot.config.get(
+                   'async_reply_ack', '')
+        return DeferredReply(phone, user_input, session, response_buffer,
+                             ack)
+
+    return finish_conversation(phone, user_input, session, response_buffer,
+                               status)
+
+
+def run_steps(phone, user_input, session, response_buffer, allow_defer=False):
+    """Advance the session through its flow, appending replies to response_buffer.
+
+    Returns 'done' when the flow ends or waits for input, 'rejected' when a
+    validate step turned the input away, or 'deferred' when allow_defer is
+    set and the next step is an async_reply action.
+    """
     max_loops = 50
     loop_count = 0
+    status = 'done'
+    flow = session.snapshot.graph.get(session['current_flow'])
 
     while True:
         if loop_count >= max_loops:
@@ -657,94 +3609,86 @@ def process_conversation(phone, user_input, is_scheduled=False):
             break
         loop_count += 1
 
-        steps = db.get_steps_for_flow(session['current_flow'])
-
-        if session['step_order'] >= len(steps):
+        if flow is None or session['step_order'] >= len(flow.steps):
             session['current_flow'] = None
             break
 
-        current_step = steps[session['step_order']]
-        step_type = current_step.get('type')
-        content = current_step.get('content')
-        variable = current_step.get('variable')
-        action_name = current_step.get('action_name')
-        condition = current_step.get('condition')
-        target_flow = current_step.get('target_flow')
+        current_step = flow.steps[session['step_order']]
+        step_type = current_step.type
 
         if step_type == 'response':
-            out_text = content
-            if out_text and '{' in out_text:
-                for k, v in session['slots'].items():
-                    val = str(v) if v is not None else ""
-                    out_text = out_text.replace(f"{{{k}}}", val)
-            response_buffer.append(out_text)
+            response_buffer.append(current_step.render(session['slots']))
             session['step_order'] += 1
 
         elif step_type == 'action':
-            ActionEngine.execute(action_name, session, phone)
+            if allow_defer and current_step.async_reply:
+                print(f"Deferring reply at {current_step.action_name}")
+                status = 'deferred'
+                break
+            session.begin_side_effects()
+            with timed(action_seconds, current_step.action_name):
+                ActionEngine.execute(current_step.action_name, session, phone)
             session['step_order'] += 1
 
         elif step_type == 'branch':
-            condition_met = check_guard(condition, user_input,
-                                        session['slots'])
-            if condition_met:
-                print(f"Branching to {target_flow}")
-                session['current_flow'] = target_flow
+            guard = current_step.guard
+            if guard and guard(user_input, session['slots']):
+                print(f"Branching to {current_step.target_flow}")
+                session['current_flow'] = current_step.target_flow
                 session['step_order'] = 0
+                flow = current_step.target
                 continue
             else:
                 session['step_order'] += 1
 
         elif step_type == 'validate':
-            is_blocked = check_guard(condition, user_input, session['slots'])
-            if is_blocked:
-                response_buffer.append(f"Please reply with '{content}'.")
-                UserManager.save_session(phone, session)
-                return "\n".join(response_buffer)
+            guard = current_step.guard
+            if guard and guard(user_input, session['slots']):
+                response_buffer.append(
+                    f"Please reply with '{current_step.content}'.")
+                status = 'rejected'
+                break
             session['step_order'] += 1
 
         elif step_type == 'collect':
-            if variable in session['slots']:
+            if current_step.variable in session['slots']:
                 session['step_order'] += 1
             else:
-                session['pending_slot'] = variable
+                session['pending_slot'] = current_step.variable
                 break
 
         elif step_type == 'schedule':
-            delay_hours = current_step.get('delay_hours')
-            delay_days = current_step.get('delay_days')
-            resume_time = current_step.get('resume_time')
-            resume_weekday = current_step.get('resume_weekday')
-
             next_step = str(session['step_order'] + 1)
 
-            ScheduleManager.schedule_step(user_id=session.get('user_id'),
-                                          flow_id=session['current_flow'],
-                                          step_id=next_step,
-                                          timezone=session.get(
-                                              'timezone', 'America/New_York'),
-                                          delay_hours=delay_hours,
-                                          delay_days=delay_days,
-                                          resume_time=resume_time,
-                                          resume_weekday=resume_weekday)
-
-            if content:
-                out_text = content
-                if '{' in out_text:
-                    for k, v in session['slots'].items():
-                        val = str(v) if v is not None else ""
-                        out_text = out_text.replace(f"{{{k}}}", val)
-                response_buffer.append(out_text)
+            session.begin_side_effects()
+            ScheduleManager.schedule_step(
+                user_id=session.get('user_id'),
+                flow_id=session['current_flow'],
+                step_id=next_step,
+                timezone=session.get('timezone', 'America/New_York'),
+                delay_hours=current_step.delay_hours,
+                delay_days=current_step.delay_days,
+                resume_time=current_step.resume_time,
+                resume_weekday=current_step.resume_weekday,
+                phone=phone)
+
+            if current_step.content:
+                response_buffer.append(current_step.render(session['slots']))
 
             session['step_order'] += 1
             session['current_flow'] = None
             break
 
-    UserManager.save_session(phone, session)
+    flow_loop_iterations.observe(loop_count)
+    return status
+
+
+def finish_conversation(phone, user_input, session, response_buffer, status):
+    session.flush()
 
     final_response_text = "\n".join(response_buffer) if response_buffer else ""
 
-    if final_response_text:
+    if final_response_text and status != 'rejected':
         ConversationLogger.log(user_id=session.get('user_id'),
                                channel_id=phone,
                                user_message=user_input,
@@ -755,110 +3699,1132 @@ def process_conversation(phone, user_input, is_scheduled=False):
     return final_response_text
 
 
-def process_scheduled_tasks():
-    tasks = ScheduleManager.get_due_tasks()
-    for task in tasks:
-        try:
-            user_data = task.get('users', {})
-            phone = user_data.get('phone') if user_data else None
+class DeferredReply:
+    """A conversation paused in front of an async_reply action.
 
-            if not phone:
-                print(f"No phone for task {task['id']}, skipping")
-                ScheduleManager.mark_completed(task['id'])
-                continue
+    The webhook answers with `ack` straight away; `complete` runs on
+    reply_executor, finishes the flow and delivers the buffered text
+    through the REST API. The webhook hands over its phone lock (`lock`),
+    which is released only once the reply is sent.
+    """
 
-            flow_id = task['flow_id']
-            step_id = task['step_id']
+    def __init__(self, phone, user_input, session, response_buffer, ack):
+        self.phone = phone
+        self.user_input = user_input
+        self.session = session
+        self.response_buffer = response_buffer
+        self.ack = ack
+        self.lock = None
 
-            session = UserManager.get_session(phone)
-            if session:
-                session['current_flow'] = flow_id
-                session['step_order'] = int(step_id)
-                UserManager.save_session(phone, session)
+    def complete(self):
+        try:
+            self._complete()
+        finally:
+            if self.lock:
+                self.lock.release()
 
-            response = process_conversation(phone, '', is_scheduled=True)
+    def _complete(self):
+        session = self.session
+        try:
+            status = run_steps(self.phone, self.user_input, session,
+                               self.response_buffer)
+            response_text = finish_conversation(self.phone, self.user_input,
+                                                session,
+                                                self.response_buffer, status)
+        except SessionConflict:
+            print(f"Session for {self.phone} changed during deferred reply, replaying turn")
+            session = RequestSession.load(self.phone)
+            try:
+                response_text = run_inbound_turn(session, self.user_input)
+            except Exception as e:
+                print(f"Deferred Engine Error: {e}")
+                flush_after_error(session)
+                response_text = "System Error. Text STOP."
+        except Exception as e:
+            print(f"Deferred Engine Error: {e}")
+            import traceback
+            traceback.print_exc()
+            flush_after_error(session)
+            response_text = "System Error. Text STOP."
+
+        if response_text:
+            send_sms(self.phone, response_text, session.reply_flow)
+
+
+class DispatchMetrics:
+    """Totals and the most recent run of the scheduled-task dispatcher."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.runs = 0
+        self.tasks = 0
+        self.sent = 0
+        self.failed = 0
+        self.last_run = None
+
+    def record(self, run):
+        with self._lock:
+            self.runs += 1
+            self.tasks += run['tasks']
+            self.sent += run['sent']
+            self.failed += run['failed']
+            self.last_run = run
+
+    def stats(self):
+        with self._lock:
+            return {
+                'runs': self.runs,
+                'tasks': self.tasks,
+                'sent': self.sent,
+                'failed': self.failed,
+                'last_run': self.last_run
+            }
+
+
+dispatch_metrics = DispatchMetrics()
+dispatch_executor = ThreadPoolExecutor(max_workers=SCHEDULER_DISPATCH_WORKERS,
+                                       thread_name_prefix='dispatch')
+
+
+def scheduler_worker_id():
+    return os.environ.get('SCHEDULER_WORKER_ID') or f"{socket.gethostname()}:{os.getpid()}"
+
+
+def claim_due_tasks(tasks, worker_id, lease_until):
+    candidates = OrderedDict((task['id'], task) for task in tasks)
+    ids = list(candidates)
+    claimed = []
+    for start in range(0, len(ids), SCHEDULER_CLAIM_BATCH):
+        for row in ScheduleManager.claim_tasks(
+                ids[start:start + SCHEDULER_CLAIM_BATCH], worker_id,
+                lease_until):
+            claimed.append({**candidates[row['id']], **row})
+    return claimed
+
+
+def run_phone_tasks(phone, tasks, worker_id):
+    """Run one user's due tasks in order; returns (completed_ids, sent, failed).
+
+    Each task comes with one SMS token taken by process_scheduled_tasks,
+    which pays for its first message; a task that sends nothing gives it
+    back. Right before each task its lease is renewed, which also checks
+    that this worker still holds it: a task whose lease ran out while it
+    waited (and that another worker may have reclaimed) is skipped, not
+    sent twice. The group's completions are written as soon as it is
+    done, so a crash later in the run can only resend the groups still
+    in flight.
+    """
+    completed = []
+    sent = 0
+    failed = 0
+    for task in tasks:
+        if not ScheduleManager.renew_lease(task['id'], worker_id):
+            print(f"Lost the lease on task {task['id']}, leaving it to its new owner")
+            sms_rate_limiter.release()
+            continue
+        lock = phone_locks.acquire(phone)
+        prepaid = True
+        try:
+            scheduler_lag_seconds.observe(
+                max(time.time() - parse_execute_at(task['execute_at']), 0.0))
+            session = RequestSession.load(phone)
+            session['current_flow'] = task['flow_id']
+            session['step_order'] = int(task['step_id'])
+
+            response = process_conversation(phone,
+                                            '',
+                                            is_scheduled=True,
+                                            session=session)
             if response:
-                send_sms(phone, response)
+                prepaid = False
+                if send_sms(phone, response, session.reply_flow, bulk=True,
+                            prepaid=True):
+                    sent += 1
 
-            ScheduleManager.mark_completed(task['id'])
+            completed.append(task['id'])
             print(f"Processed scheduled task {task['id']} for {phone}")
 
         except Exception as e:
-            print(f"Error processing scheduled task: {e}")
+            failed += 1
+            print(f"Error processing scheduled task {task.get('id')}: {e}")
+        finally:
+            if prepaid:
+                sms_rate_limiter.release()
+            if lock:
+                lock.release()
+    ScheduleManager.mark_completed_many(completed, worker_id)
+    return completed, sent, failed
+
+
+def process_scheduled_tasks(tasks=None):
+    if tasks is None:
+        tasks = ScheduleManager.get_due_tasks()
+        scheduler_engine.forget(task['id'] for task in tasks)
+    if not tasks:
+        return None
+
+    # a run only claims the tasks it already holds an SMS token for, so
+    # none sit claimed behind the bucket while their leases run out; the
+    # rest are retried once the bucket has refilled
+    tasks = sorted(tasks, key=lambda t: t.get('execute_at') or '')
+    budget = sms_rate_limiter.try_acquire(len(tasks))
+    if budget < len(tasks):
+        scheduler_engine.defer(tasks[budget:],
+                               sms_rate_limiter.refill_seconds())
+        tasks = tasks[:budget]
+    if not tasks:
+        return None
+
+    started = time.monotonic()
+    worker_id = scheduler_worker_id()
+    lease_until = datetime.now(pytz.UTC) + timedelta(
+        seconds=SCHEDULER_LEASE_SECONDS)
+    candidates = len(tasks)
+    tasks = claim_due_tasks(tasks, worker_id, lease_until)
+    sms_rate_limiter.release(candidates - len(tasks))
+    if not tasks:
+        return None
+
+    completed = []
+    by_phone = OrderedDict()
+    for task in sorted(tasks, key=lambda t: t.get('execute_at') or ''):
+        user_data = task.get('users', {})
+        phone = user_data.get('phone') if user_data else None
+        if not phone:
+            print(f"No phone for task {task['id']}, skipping")
+            completed.append(task['id'])
+            sms_rate_limiter.release()
+            continue
+        by_phone.setdefault(phone, []).append(task)
+    ScheduleManager.mark_completed_many(completed, worker_id)
+
+    futures = [
+        dispatch_executor.submit(run_phone_tasks, phone, phone_tasks,
+                                 worker_id)
+        for phone, phone_tasks in by_phone.items()
+    ]
+    sent = 0
+    failed = 0
+    for future in futures:
+        done_ids, phone_sent, phone_failed = future.result()
+        completed.extend(done_ids)
+        sent += phone_sent
+        failed += phone_failed
+
+    elapsed = time.monotonic() - started
+    run = {
+        'worker': worker_id,
+        'candidates': candidates,
+        'tasks': len(tasks),
+        'users': len(by_phone),
+        'completed': len(completed),
+        'sent': sent,
+        'failed': failed,
+        'seconds': round(elapsed, 3),
+        'tasks_per_second': round(len(tasks) / elapsed, 1) if elapsed else None
+    }
+    dispatch_metrics.record(run)
+    print(f"Dispatched {run['tasks']} scheduled tasks for {run['users']} users "
+          f"in {run['seconds']}s ({run['sent']} sent, {run['failed']} failed)")
+    return run
+
+
+def parse_execute_at(value):
+    run_at = datetime.fromisoformat(value)
+    if run_at.tzinfo is None:
+        run_at = run_at.replace(tzinfo=pytz.UTC)
+    return run_at.timestamp()
+
+
+class SchedulerEngine:
+    """Holds upcoming scheduled_tasks in a min-heap and sleeps until the next is due.
+
+    The heap is refilled from Supabase one window at a time (everything
+    Pending that is due within `window_minutes`), and tasks created by
+    ScheduleManager.schedule_step in this process are pushed in directly.
+    Tasks due beyond the window are picked up by a later refill.
+    """
+
+    RETRY_SECONDS = 30
+
+    def __init__(self, window_minutes=10):
+        self.window_seconds = window_minutes * 60
+        self._heap = []
+        self._known = set()
+        self._cond = threading.Condition()
+        self._window_end = None
+        self._sequence = itertools.count()
+        self.refills = 0
+        self.dispatched = 0
+        self.last_lag_seconds = None
+        self.max_lag_seconds = 0.0
+
+    def add(self, task):
+        try:
+            run_at = parse_execute_at(task['execute_at'])
+        except (KeyError, TypeError, ValueError) as e:
+            print(f"Scheduler ignoring task without valid execute_at: {e}")
+            return
+        with self._cond:
+            if self._window_end is None or run_at > self._window_end:
+                return
+            self._push_locked(run_at, task)
+            self._cond.notify()
+
+    def _push_locked(self, run_at, task):
+        if task['id'] in self._known:
+            return
+        self._known.add(task['id'])
+        heapq.heappush(self._heap, (run_at, next(self._sequence), task))
+
+    def defer(self, tasks, seconds):
+        """Put due tasks back on the heap to run `seconds` from now."""
+        run_at = time.time() + seconds
+        with self._cond:
+            for task in tasks:
+                self._push_locked(run_at, task)
+            self._cond.notify()
+
+    def forget(self, task_ids):
+        with self._cond:
+            self._known.difference_update(task_ids)
+
+    def refill(self):
+        now = time.time()
+        until = now + self.window_seconds
+        try:
+            ScheduleManager.release_expired_leases()
+            tasks = ScheduleManager.fetch_due_tasks(
+                datetime.fromtimestamp(until, pytz.UTC)) if get_storage() else []
+        except Exception as e:
+            print(f"Scheduler refill failed: {e}")
+            until = now + self.RETRY_SECONDS
+            tasks = []
+        with self._cond:
+            for task in tasks:
+                try:
+                    self._push_locked(parse_execute_at(task['execute_at']),
+                                      task)
+                except (KeyError, TypeError, ValueError):
+                    continue
+            self._window_end = until
+            self.refills += 1
+
+    def _pop_due_locked(self, now):
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            run_at, _, task = heapq.heappop(self._heap)
+            if task['id'] not in self._known:
+                continue
+            self._known.discard(task['id'])
+            lag = now - run_at
+            self.last_lag_seconds = lag
+            self.max_lag_seconds = max(self.max_lag_seconds, lag)
+            due.append(task)
+        return due
+
+    def tick(self):
+        now = time.time()
+        if self._window_end is None or now >= self._window_end:
+            self.refill()
+        with self._cond:
+            due = self._pop_due_locked(now)
+            if not due:
+                next_at = self._window_end
+                if self._heap:
+                    next_at = min(next_at, self._heap[0][0])
+                self._cond.wait(timeout=max(0.0, next_at - now))
+                return
+            self.dispatched += len(due)
+        process_scheduled_tasks(due)
+
+    def run(self):
+        while True:
+            try:
+                self.tick()
+            except Exception as e:
+                print(f"Scheduler error: {e}")
+                time.sleep(1)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'queued': len(self._known),
+                'next_due_in_seconds': round(self._heap[0][0] - time.time(), 1)
+                if self._heap else None,
+                'window_minutes': self.window_seconds / 60,
+                'refills': self.refills,
+                'dispatched': self.dispatched,
+                'last_lag_seconds': round(self.last_lag_seconds, 3)
+                if self.last_lag_seconds is not None else None,
+                'max_lag_seconds': round(self.max_lag_seconds, 3)
+            }
+
+
+scheduler_engine = SchedulerEngine(SCHEDULER_WINDOW_MINUTES)
 
 
 def scheduler_worker():
+    scheduler_engine.run()
+
+
+def record_survey_responses(responses):
+    """Insert (phone, slug, answers, result) tuples as survey_responses rows."""
+    storage = get_storage()
+    if not storage or not responses:
+        return
+    try:
+        storage.insert_rows('survey_responses', [{
+            'phone': phone,
+            'survey_slug': slug,
+            'answers': answers,
+            'profile': result['profile'],
+            'scores': result['scores']
+        } for phone, slug, answers, result in responses])
+    except Exception as e:
+        print(f"Error recording {len(responses)} survey responses: {e}")
+
+
+class SubmissionIntake:
+    """Survey/Typeform submissions, accepted by the webhook and applied in batches.
+
+    The webhook only validates, scores and enqueues, then answers 202.
+    Consumer threads (one per shard, so one phone's submissions stay in
+    order) take whatever is queued up to `batch_size`, keep the latest
+    submission per phone, assign the verification flow with one users
+    upsert, record the survey responses and queue the verification SMS on
+    `outbound`, which paces sends through the Twilio token bucket. The same
+    submission repeated from a phone within `dedupe_seconds` is
+    acknowledged but dropped unless the first one failed to apply, and a
+    full queue refuses new submissions so the webhook can answer 503 and
+    the sender retries.
+    """
+
+    VERIFY_FLOW = 'assessment_verify_flow'
+    THROUGHPUT_WINDOW = 60.0
+    STOP = object()
+
+    def __init__(self,
+                 max_queue=5000,
+                 batch_size=100,
+                 workers=2,
+                 dedupe_seconds=600):
+        self.batch_size = max(1, batch_size)
+        self.dedupe_seconds = dedupe_seconds
+        shards = max(1, workers)
+        self._queues = [
+            queue.Queue(maxsize=max(1, max_queue // shards))
+            for _ in range(shards)
+        ]
+        self._threads = []
+        self._lock = threading.Lock()
+        self._recent = {}
+        self._recent_order = deque()
+        self._applied = deque()
+        self._counts = {
+            'accepted': 0,
+            'duplicate': 0,
+            'rejected': 0,
+            'superseded': 0,
+            'applied': 0,
+            'failed': 0,
+            'batches': 0
+        }
+
+    def _ensure_started(self):
+        if self._threads:
+            return
+        with self._lock:
+            if self._threads:
+                return
+            for index, shard in enumerate(self._queues):
+                thread = threading.Thread(target=self._run,
+                                          args=(shard, ),
+                                          name=f'intake-{index}',
+                                          daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    @staticmethod
+    def fingerprint(submission):
+        return json.dumps([
+            submission['first_name'], submission['profile'],
+            submission.get('survey'), submission.get('answers')
+        ], sort_keys=True, default=str)
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self._counts[key] += n
+        intake_submissions.inc(key, amount=n)
+
+    def submit(self, submission):
+        """Queue a submission; returns 'accepted', 'duplicate' or 'rejected' (full)."""
+        self._ensure_started()
+        phone = submission['phone']
+        fingerprint = self.fingerprint(submission)
+        now = time.monotonic()
+        with self._lock:
+            self._forget_expired_locked(now)
+            if self._recent.get(phone, (None, ))[0] == fingerprint:
+                outcome = 'duplicate'
+            else:
+                shard = self._queues[hash(phone) % len(self._queues)]
+                try:
+                    shard.put_nowait(submission)
+                    outcome = 'accepted'
+                    self._recent[phone] = (fingerprint, now)
+                    self._recent_order.append((now, phone))
+                except queue.Full:
+                    outcome = 'rejected'
+            self._counts[outcome] += 1
+        intake_submissions.inc(outcome)
+        return outcome
+
+    def _forget(self, submissions):
+        """Drop the dedupe entries of submissions that were not applied,
+        so the sender's retry is not taken for a duplicate."""
+        with self._lock:
+            for submission in submissions:
+                phone = submission['phone']
+                if self._recent.get(phone, (None, ))[0] == \
+                        self.fingerprint(submission):
+                    del self._recent[phone]
+
+    def _forget_expired_locked(self, now):
+        while self._recent_order and \
+                now - self._recent_order[0][0] >= self.dedupe_seconds:
+            seen_at, phone = self._recent_order.popleft()
+            if self._recent.get(phone, (None, None))[1] == seen_at:
+                del self._recent[phone]
+
+    def _run(self, shard):
+        while True:
+            batch = [shard.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(shard.get_nowait())
+                except queue.Empty:
+                    break
+            stop = self.STOP in batch
+            batch = [item for item in batch if item is not self.STOP]
+            try:
+                if batch:
+                    with timed(intake_batch_seconds):
+                        self._apply(batch)
+            except Exception as e:
+                self._forget(batch)
+                self._count('failed', len(batch))
+                print(f"Intake batch error ({len(batch)} submissions): {e}")
+            for _ in range(len(batch) + stop):
+                shard.task_done()
+            if stop:
+                return
+
+    def _apply(self, batch):
+        latest = {}
+        for submission in batch:
+            latest[submission['phone']] = submission
+        if len(latest) < len(batch):
+            self._count('superseded', len(batch) - len(latest))
+
+        applied = self._assign(list(latest.values()))
+        phones = {submission['phone'] for submission in applied}
+        record_survey_responses([
+            (s['phone'], s['survey'], s['answers'], s['result'])
+            for s in batch if s['phone'] in phones and s.get('result')
+        ])
+
+        if get_twilio() and TWILIO_PHONE_NUMBER:
+            outbound.send_many((s['phone'], part) for s in applied
+                               for part in sms_packer.pack(self.verify_message(s),
+                                                          self.VERIFY_FLOW))
+        with self._lock:
+            self._counts['batches'] += 1
+            self._applied.append((time.monotonic(), len(applied)))
+        self._count('applied', len(applied))
+
+    def _assign(self, submissions):
+        """Write the verification flow for each phone; returns those written."""
+        storage = get_storage()
+        if not storage:
+            return submissions
+        rows = [{
+            'phone': s['phone'],
+            'slots': {
+                'first_name': s['first_name'],
+                'calculated_profile': s['profile']
+            },
+            'current_flow': self.VERIFY_FLOW,
+            'current_step_id': '0'
+        } for s in submissions]
+        try:
+            retry = set(storage.assign_users(rows))
+        except Exception as e:
+            # one bad row should not cost the rest of the batch
+            print(f"Intake upsert of {len(rows)} users failed, retrying one by one: {e}")
+            retry = {row['phone'] for row in rows}
+        applied = []
+        for submission, row in zip(submissions, rows):
+            if row['phone'] not in retry:
+                applied.append(submission)
+                continue
+            # rows that moved under the batch write take the versioned
+            # read-modify-write path
+            try:
+                if not UserManager.get_or_create_user(row['phone']):
+                    raise RuntimeError("no user row")
+                UserManager.assign_flow(row['phone'], self.VERIFY_FLOW,
+                                        row['slots'])
+                applied.append(submission)
+            except Exception as e:
+                self._forget([submission])
+                self._count('failed')
+                print(f"Typeform submission for {row['phone']} failed: {e}")
+        for submission in submissions:
+            session_cache.invalidate(submission['phone'])
+        return applied
+
+    @staticmethod
+    def verify_message(submission):
+        return (f"Hi {submission['first_name']}! Your Neuvero profile is ready. "
+                f"Reply YES to confirm and receive your {submission['profile']} "
+                "leadership insights.")
+
+    def drain(self, timeout=5.0):
+        end = time.monotonic() + timeout
+        while time.monotonic() < end and any(
+                shard.unfinished_tasks for shard in self._queues):
+            time.sleep(0.01)
+        return not any(shard.unfinished_tasks for shard in self._queues)
+
+    def shutdown(self, timeout=5.0):
+        for shard, thread in zip(self._queues, self._threads):
+            if not thread.is_alive():
+                continue
+            try:
+                shard.put(self.STOP, timeout=timeout)
+            except queue.Full:
+                print("Intake queue full at shutdown, pending submissions lost")
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            while self._applied and \
+                    now - self._applied[0][0] > self.THROUGHPUT_WINDOW:
+                self._applied.popleft()
+            recent = sum(n for _, n in self._applied)
+            return {
+                'queue_depth': sum(shard.qsize() for shard in self._queues),
+                'capacity': sum(shard.maxsize for shard in self._queues),
+                'workers': len(self._queues),
+                **self._counts,
+                'applied_per_second':
+                round(recent / self.THROUGHPUT_WINDOW, 2)
+            }
+
+
+submission_intake = SubmissionIntake(max_queue=INTAKE_QUEUE_SIZE,
+                                     batch_size=INTAKE_BATCH_SIZE,
+                                     workers=INTAKE_WORKERS,
+                                     dedupe_seconds=INTAKE_DEDUPE_SECONDS)
+atexit.register(submission_intake.shutdown)
+
+
+def rescore_survey(slug, batch_size=RESCORE_BATCH_SIZE):
+    """Re-score every stored response to a survey with its current definition.
+
+    Responses are read in id order, `batch_size` at a time, scored in one
+    batch and written back only when the result changed. Each phone's
+    latest response then updates its calculated_profile slot.
+    """
+    scorer = db.current().scorers.get(slug)
+    if scorer is None:
+        raise KeyError(slug)
+    storage = get_storage()
+    started = time.perf_counter()
+    run = {'survey': slug, 'responses': 0, 'rescored': 0, 'users_updated': 0}
+    latest = {}
+    after_id = 0
     while True:
+        rows = storage.fetch_survey_responses(slug, after_id, batch_size)
+        if not rows:
+            break
+        results = scorer.score_batch([row['answers'] for row in rows])
+        changed = []
+        for row, result in zip(rows, results):
+            latest[row['phone']] = result['profile']
+            if result['profile'] != row.get('profile') or result['scores'] != row.get('scores'):
+                changed.append({**row, **result})
+        if changed:
+            storage.update_survey_scores(changed)
+        run['responses'] += len(rows)
+        run['rescored'] += len(changed)
+        after_id = rows[-1]['id']
+
+    for phone, profile in latest.items():
+        lock = phone_locks.acquire(phone)
+        try:
+            if UserManager.update_slots(phone, {'calculated_profile': profile}):
+                run['users_updated'] += 1
+        except SessionConflict:
+            print(f"Could not update profile for {phone}, row kept changing")
+        finally:
+            if lock:
+                lock.release()
+
+    run['seconds'] = round(time.perf_counter() - started, 3)
+    print(f"Rescored {run['responses']} '{slug}' responses in {run['seconds']}s "
+          f"({run['rescored']} changed, {run['users_updated']} users updated)")
+    return run
+
+
+class HealthMonitor:
+    """Cached dependency probes behind /health, /health/ready and /health/live.
+
+    Each remote probe runs at most once per HEALTH_CACHE_SECONDS on a small
+    pool, so load-balancer polling cannot pile onto storage or Gemini, and
+    a hung dependency fails its probe after HEALTH_PROBE_TIMEOUT instead of
+    hanging the check. Readiness fails (503) when storage is unreachable or
+    slower than HEALTH_STORAGE_MAX_MS, the log queue is nearly full or no
+    flows are loaded, so traffic is shed before latency collapses; Gemini,
+    the scheduled-task backlog and a backed-up intake queue only mark the
+    service degraded.
+    """
+
+    READY_CHECKS = ('storage', 'log_queue', 'flows')
+
+    def __init__(self, ttl, probe_timeout):
+        self.ttl = ttl
+        self.probe_timeout = probe_timeout
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=3,
+                                        thread_name_prefix='health')
+        self._results = {}
+        self._pending = {}
+
+    def probe_storage(self):
+        storage = get_storage()
+        if not storage:
+            raise RuntimeError("no storage backend")
+        storage.ping()
+        return {'backend': storage.name}
+
+    def probe_gemini(self):
+        model = get_gemini_model()
+        if not model:
+            raise RuntimeError("Gemini not configured")
+        if hasattr(model, 'count_tokens'):
+            model.count_tokens("ping")
+        return {}
+
+    def probe_backlog(self):
+        storage = get_storage()
+        if not storage:
+            raise RuntimeError("no storage backend")
+        now = time.time()
+        cutoff = datetime.fromtimestamp(now - HEALTH_OVERDUE_GRACE_SECONDS,
+                                        pytz.UTC)
+        overdue = storage.count_overdue_tasks(cutoff.isoformat())
+        oldest = overdue['oldest']
+        age = round(now - parse_execute_at(oldest), 1) if oldest else 0.0
+        return {
+            'overdue': overdue['count'],
+            'oldest_overdue_seconds': age,
+            'ok': age <= HEALTH_MAX_OVERDUE_SECONDS
+        }
+
+    def _run(self, name):
+        started = time.perf_counter()
         try:
-            process_scheduled_tasks()
+            result = {'ok': True, **getattr(self, f"probe_{name}")()}
         except Exception as e:
-            print(f"Scheduler error: {e}")
-        time.sleep(60)
+            result = {'ok': False, 'error': str(e)}
+        result['probe_ms'] = round((time.perf_counter() - started) * 1000, 1)
+        with self._lock:
+            self._results[name] = (time.monotonic(), result)
+            self._pending.pop(name, None)
+        return result
+
+    def probe(self, name):
+        with self._lock:
+            cached = self._results.get(name)
+            if cached and time.monotonic() - cached[0] < self.ttl:
+                return dict(cached[1])
+            pending = self._pending.get(name)
+            if pending is None:
+                pending = self._pending[name] = (self._pool.submit(
+                    self._run, name), time.monotonic())
+        future, started = pending
+        # a probe already stuck past the timeout fails at once, so callers
+        # do not each wait out the same hung dependency
+        wait = self.probe_timeout - (time.monotonic() - started)
+        try:
+            return dict(future.result(timeout=max(wait, 0)))
+        except FuturesTimeout:
+            return {
+                'ok': False,
+                'error': f"no answer within {self.probe_timeout:g}s"
+            }
+
+    def checks(self):
+        storage = self.probe('storage')
+        if storage['ok'] and storage['probe_ms'] > HEALTH_STORAGE_MAX_MS:
+            storage['ok'] = False
+            storage['error'] = f"round trip over {HEALTH_STORAGE_MAX_MS:g}ms"
+
+        log = log_pipeline.stats()
+        intake = submission_intake.stats()
+        snapshot = db.current()
+        return {
+            'storage': storage,
+            'gemini': self.probe('gemini'),
+            'scheduled_backlog': self.probe('backlog'),
+            'log_queue': {
+                'ok': log['queue_depth'] < log['capacity'] * HEALTH_LOG_QUEUE_MAX,
+                'depth': log['queue_depth'],
+                'capacity': log['capacity']
+            },
+            'intake_queue': {
+                'ok': intake['queue_depth'] < intake['capacity'] * HEALTH_LOG_QUEUE_MAX,
+                'depth': intake['queue_depth'],
+                'capacity': intake['capacity'],
+                'applied_per_second': intake['applied_per_second']
+            },
+            'flows': {
+                'ok': bool(snapshot.flows),
+                'version': snapshot.version,
+                'age_seconds': round(time.time() - snapshot.loaded_at, 1)
+            }
+        }
 
+    def readiness(self):
+        """(status, failing check names, checks); status is healthy/degraded/unhealthy."""
+        checks = self.checks()
+        failing = [name for name in self.READY_CHECKS if not checks[name]['ok']]
+        if failing:
+            status = 'unhealthy'
+        elif all(check['ok'] for check in checks.values()):
+            status = 'healthy'
+        else:
+            status = 'degraded'
+        return status, failing, checks
 
-@app.route('/sms', methods=['POST'])
-def sms_reply():
-    if missing_vars:
-        return jsonify({
-            "error": "Service Config Error",
-            "missing": missing_vars
-        }), 500
+    def liveness(self):
+        """Problems that a restart would fix; no remote calls."""
+        problems = []
+        if scheduler_thread and not scheduler_thread.is_alive():
+            problems.append("scheduler thread stopped")
+        if db.current() is None:
+            problems.append("no flow snapshot")
+        return problems
 
-    incoming_msg = request.values.get('Body', '').strip()
-    from_number = request.values.get('From', '')
 
-    print(f"SMS From {from_number}: {incoming_msg}")
+health_monitor = HealthMonitor(HEALTH_CACHE_SECONDS, HEALTH_PROBE_TIMEOUT)
 
-    session = UserManager.get_session(from_number)
-    is_trigger = db.find_trigger_flow(incoming_msg)
 
-    if session and session.get('pending_slot') and not is_trigger:
+def load_brotli():
+    """The brotli module when it is installed, else None (gzip only)."""
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli
+
+
+class RenderedPage:
+    """One rendered page with its precompressed bodies and validators."""
+
+    def __init__(self, html, last_modified):
+        self.body = html.encode('utf-8')
+        self.etag = hashlib.sha1(self.body).hexdigest()[:20]
+        self.last_modified = datetime.fromtimestamp(int(last_modified), pytz.UTC)
+        self.encoded = {'gzip': gzip.compress(self.body, compresslevel=9, mtime=0)}
+        brotli = load_brotli()
+        if brotli:
+            self.encoded['br'] = brotli.compress(self.body)
+
+
+class PageCache:
+    """Rendered assessment pages keyed by (page, snapshot version).
+
+    Survey pages take the LinkedIn traffic spikes, so each is rendered and
+    compressed once per flow snapshot and then served like a static file,
+    with an ETag and Last-Modified for 304s. Entries for older snapshots
+    are dropped on the first request after a reload.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pages = {}
+        self._version = None
+        self.hits = 0
+        self.renders = 0
+        self.not_modified = 0
+
+    def get(self, key, snapshot, render):
+        with self._lock:
+            if self._version != snapshot.version:
+                self._pages = {}
+                self._version = snapshot.version
+            page = self._pages.get(key)
+            if page is None:
+                # rendering under the lock keeps a spike from rendering the
+                # same page once per waiting request
+                page = self._pages[key] = RenderedPage(render(), snapshot.loaded_at)
+                self.renders += 1
+            else:
+                self.hits += 1
+        return page
+
+    def respond(self, page):
+        response = Response(page.body, mimetype='text/html')
+        accepted = request.accept_encodings
+        for encoding in ('br', 'gzip'):
+            if encoding in page.encoded and accepted[encoding]:
+                response.set_data(page.encoded[encoding])
+                response.headers['Content-Encoding'] = encoding
+                break
+        response.headers['Vary'] = 'Accept-Encoding'
+        response.cache_control.public = True
+        response.cache_control.max_age = PAGE_CACHE_MAX_AGE
+        # weak, so the one validator covers every encoding of the page
+        response.set_etag(page.etag, weak=True)
+        response.last_modified = page.last_modified
+        response.make_conditional(request)
+        if response.status_code == 304:
+            with self._lock:
+                self.not_modified += 1
+        return response
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pages': len(self._pages),
+                'version': self._version,
+                'hits': self.hits,
+                'renders': self.renders,
+                'not_modified': self.not_modified,
+                'brotli': load_brotli() is not None
+            }
+
+
+page_cache = PageCache()
+
+
+bp = Blueprint('pulse', __name__)
+
+
+def run_inbound_turn(session, incoming_msg, allow_defer=False):
+    """Fill a pending slot from the message and run the conversation."""
+    is_trigger = session.snapshot.find_trigger_flow(incoming_msg)
+
+    if session.get('pending_slot') and not is_trigger:
         slot_name = session['pending_slot']
         print(f"Filling Slot {slot_name} with '{incoming_msg}'")
         session['slots'][slot_name] = incoming_msg
         session['pending_slot'] = None
-        UserManager.save_session(from_number, session)
 
+    return process_conversation(session.phone,
+                                incoming_msg,
+                                session=session,
+                                trigger_flow=is_trigger,
+                                allow_defer=allow_defer)
+
+
+def flush_after_error(session):
+    try:
+        session.flush()
+    except SessionConflict:
+        pass
+
+
+def handle_inbound_sms(from_number, incoming_msg):
+    """Run one inbound SMS through the engine and return the TwiML reply.
+
+    Shared by the Flask route and the ASGI entry point so both answer
+    byte-for-byte the same. The turn holds the phone's lock; if another
+    process saved the users row first, the turn is replayed from the
+    fresh row (up to SESSION_MAX_RETRIES times) as long as none of its
+    actions or schedule steps had run yet.
+    """
+    print(f"SMS From {from_number}: {incoming_msg}")
+
+    started = time.perf_counter()
+    trace = start_trace('sms')
+    lock = phone_locks.acquire(from_number)
+    session = None
+    deferred = None
     try:
-        response_text = process_conversation(from_number, incoming_msg)
+        for attempt in range(SESSION_MAX_RETRIES + 1):
+            session = RequestSession.load(from_number)
+            try:
+                response_text = run_inbound_turn(session,
+                                                 incoming_msg,
+                                                 allow_defer=True)
+                break
+            except SessionConflict:
+                if attempt == SESSION_MAX_RETRIES:
+                    raise
+                print(f"Session for {from_number} changed underneath us, retrying")
+        if isinstance(response_text, DeferredReply):
+            deferred = response_text
+            response_text = deferred.ack
+            deferred.lock, lock = lock, None
+            reply_executor.submit(deferred.complete)
     except Exception as e:
         print(f"Engine Error: {e}")
         import traceback
         traceback.print_exc()
+        if session:
+            flush_after_error(session)
         response_text = "System Error. Text STOP."
+    finally:
+        if lock:
+            lock.release()
 
+    reply_flow = session.reply_flow if session else None
     resp = MessagingResponse()
-    resp.message(response_text)
+    parts = sms_packer.pack(response_text, reply_flow)
+    for part in parts:
+        resp.message(part)
+    if not parts and not deferred:
+        resp.message(response_text)
+    webhook_seconds.observe(time.perf_counter() - started,
+                            reply_flow or 'none')
+    end_trace(trace)
     return str(resp)
 
 
-@app.route('/health', methods=['GET'])
+@bp.route('/sms', methods=['POST'])
+def sms_reply():
+    if missing_vars:
+        return jsonify({
+            "error": "Service Config Error",
+            "missing": missing_vars
+        }), 500
+
+    incoming_msg = request.values.get('Body', '').strip()
+    from_number = request.values.get('From', '')
+    return handle_inbound_sms(from_number, incoming_msg)
+
+
+@bp.route('/health', methods=['GET'])
 def health_check():
+    status, _, checks = health_monitor.readiness()
     return jsonify({
         "status":
-        "healthy",
+        status,
+        "checks":
+        checks,
         "service":
         "Neuvero Pulse SMS service",
         "database":
-        "Supabase",
+        get_storage().name if get_storage() else None,
         "features":
-        ["persistent_sessions", "scheduled_flows", "events_logging"]
+        ["persistent_sessions", "scheduled_flows", "events_logging"],
+        "session_cache":
+        session_cache.stats(),
+        "llm":
+        llm_executor.stats(),
+        "llm_cache":
+        llm_cache.stats() if llm_cache else None,
+        "log_pipeline":
+        log_pipeline.stats(),
+        "scheduler":
+        scheduler_engine.stats(),
+        "dispatch":
+        dispatch_metrics.stats(),
+        "startup":
+        startup_timings,
+        "phone_locks":
+        phone_locks.stats(),
+        "outbound":
+        outbound.stats(),
+        "sms_segments":
+        sms_packer.stats(),
+        "assessment_pages":
+        page_cache.stats(),
+        "intake":
+        submission_intake.stats()
     }), 200
 
 
-@app.route('/refresh', methods=['GET'])
+@bp.route('/health/live', methods=['GET'])
+def liveness_check():
+    problems = health_monitor.liveness()
+    if problems:
+        return jsonify({"status": "dead", "problems": problems}), 503
+    return jsonify({"status": "alive"}), 200
+
+
+@bp.route('/health/ready', methods=['GET'])
+def readiness_check():
+    status, failing, checks = health_monitor.readiness()
+    if failing:
+        return jsonify({
+            "status": "not_ready",
+            "failing": failing,
+            "checks": checks
+        }), 503
+    return jsonify({"status": status, "checks": checks}), 200
+
+
+@bp.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    scheduler = scheduler_engine.stats()
+    intake = submission_intake.stats()
+    body = metrics.render(gauges=(
+        ('pulse_log_queue_depth', 'Conversation log rows waiting to be written',
+         log_pipeline.stats()['queue_depth']),
+        ('pulse_outbound_queued', 'Outbound SMS waiting to be sent',
+         outbound.stats()['queued']),
+        ('pulse_intake_queue_depth', 'Survey/Typeform submissions waiting to be applied',
+         intake['queue_depth']),
+        ('pulse_intake_applied_per_second', 'Submissions applied per second over the last minute',
+         intake['applied_per_second']),
+        ('pulse_scheduler_queued', 'Scheduled tasks held in the in-memory heap',
+         scheduler['queued']),
+        ('pulse_flows_version', 'Version of the flow snapshot being served',
+         db.current().version),
+    ))
+    return body, 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
+@bp.route('/traces', methods=['GET'])
+def recent_traces_endpoint():
+    return jsonify({
+        "sample_rate": TRACE_SAMPLE_RATE,
+        "traces": list(recent_traces)
+    }), 200
+
+
+@bp.route('/refresh', methods=['GET'])
 def refresh_logic():
-    db.refresh_data()
-    return jsonify({"status": "Logic Refreshed from YAML"}), 200
+    snapshot = db.refresh_data()
+    return jsonify({
+        "status": "Logic Refreshed from YAML",
+        "version": snapshot.version,
+        "reloaded_modules_ms": snapshot.module_times
+    }), 200
 
 
-@app.route('/process-scheduled', methods=['POST'])
+@bp.route('/surveys/<slug>/rescore', methods=['POST'])
+def rescore_survey_endpoint(slug):
+    try:
+        return jsonify(rescore_survey(slug)), 200
+    except KeyError:
+        return jsonify({"error": f"Unknown survey '{slug}'"}), 404
+
+
+@bp.route('/process-scheduled', methods=['POST'])
 def trigger_scheduled():
     process_scheduled_tasks()
     return jsonify({"status": "Processed scheduled tasks"}), 200
 
 
-@app.route('/', methods=['GET'])
+@bp.route('/', methods=['GET'])
 def home():
     return jsonify({
         "message":
@@ -866,42 +4832,53 @@ def home():
         "webhook_endpoint":
         "/sms",
         "database":
-        "Supabase",
+        get_storage().name if get_storage() else None,
         "features":
         ["persistent_sessions", "scheduled_flows", "events_logging"]
     }), 200
 
 
-@app.route('/assessment/<slug>', methods=['GET'])
+@bp.route('/assessment/<slug>', methods=['GET'])
 def show_dynamic_assessment(slug):
-    survey_data = None
-    
-    for flow_id, flow_def in db.flows.items():
-        web_config = flow_def.get('web_survey')
-        if web_config and web_config.get('slug') == slug:
-            survey_data = web_config
-            break
-    
+    snapshot = db.current()
+    survey_data = snapshot.surveys.get(slug)
     if not survey_data:
         return "Survey not found", 404
 
-    return render_template('assessment_engine.html', survey=survey_data)
+    page = page_cache.get(
+        ('survey', slug), snapshot,
+        lambda: render_template('assessment_engine.html', survey=survey_data))
+    return page_cache.respond(page)
 
 
-@app.route('/assessment', methods=['GET'])
+@bp.route('/assessment', methods=['GET'])
 def show_assessment():
-    return render_template('assessment.html')
+    page = page_cache.get(('legacy', ), db.current(),
+                          lambda: render_template('assessment.html'))
+    return page_cache.respond(page)
+
+
+PHONE_PATTERN = re.compile(r'^\+\d{8,15}$')
 
 
-@app.route('/hooks/typeform', methods=['POST'])
+@bp.route('/hooks/typeform', methods=['POST'])
 def typeform_webhook():
-    data = request.get_json()
-    if not data:
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not data:
         return jsonify({"error": "No data provided"}), 400
     
-    phone = data.get('phone', '').strip()
-    first_name = data.get('first_name', '').strip()
+    phone = str(data.get('phone') or '').strip()
+    first_name = str(data.get('first_name') or '').strip()
     calculated_profile = data.get('calculated_profile', 'Unknown')
+
+    # Answers from our own survey pages are scored here; a profile sent by
+    # the browser (or Typeform) is only trusted when there are none.
+    scorer = db.current().scorers.get(data.get('survey'))
+    answers = data.get('answers')
+    survey_result = None
+    if scorer and isinstance(answers, dict):
+        survey_result = scorer.score(answers)
+        calculated_profile = survey_result['profile']
     
     if not phone:
         return jsonify({"error": "Phone number required"}), 400
@@ -912,39 +4889,34 @@ def typeform_webhook():
             phone = '+' + phone
         elif len(phone) == 10:
             phone = '+1' + phone
-    
-    try:
-        user = UserManager.get_or_create_user(phone)
-        if user:
-            slots = {'first_name': first_name, 'calculated_profile': calculated_profile}
-            supabase.table('users').update({
-                'slots': slots,
-                'current_flow': 'assessment_verify_flow',
-                'current_step_id': '0'
-            }).eq('phone', phone).execute()
-        
-        if twilio_client and TWILIO_PHONE_NUMBER:
-            verify_msg = f"Hi {first_name}! Your Neuvero profile is ready. Reply YES to confirm and receive your {calculated_profile} leadership insights."
-            twilio_client.messages.create(
-                body=verify_msg,
-                from_=TWILIO_PHONE_NUMBER,
-                to=phone
-            )
-            print(f"Sent verification SMS to {phone}")
-        
-        return jsonify({"status": "success", "phone": phone}), 200
-        
-    except Exception as e:
-        print(f"Typeform webhook error: {e}")
-        return jsonify({"error": str(e)}), 500
-
+    if not PHONE_PATTERN.match(phone):
+        return jsonify({"error": "Invalid phone number"}), 400
+
+    # Users, survey responses and the verification SMS are written by the
+    # intake consumers, so a campaign burst costs each request no network calls
+    outcome = submission_intake.submit({
+        'phone': phone,
+        'first_name': first_name,
+        'profile': calculated_profile,
+        'survey': scorer.slug if survey_result else None,
+        'answers': answers if survey_result else None,
+        'result': survey_result
+    })
+    if outcome == 'rejected':
+        return jsonify({"error": "Too many submissions, retry shortly"}), 503, {
+            'Retry-After': '5'
+        }
+    return jsonify({"status": outcome, "phone": phone}), 202
 
 scheduler_started = False
+scheduler_thread = None
+services_started = False
+services_lock = threading.Lock()
 
 
 def start_scheduler():
-    global scheduler_started
-    if scheduler_started:
+    global scheduler_started, scheduler_thread
+    if scheduler_started or not SCHEDULER_ENABLED:
         return
     scheduler_started = True
     scheduler_thread = threading.Thread(target=scheduler_worker, daemon=True)
@@ -952,15 +4924,210 @@ def start_scheduler():
     print("Scheduler worker started")
 
 
-start_scheduler()
+def warm_clients():
+    for client in (get_storage, get_twilio, get_gemini_model):
+        client()
+    storage = get_storage()
+    if storage:
+        # find out now whether users.version exists, not on the first turn
+        storage.supports_versions()
+
+
+def start_background_services():
+    """Start the scheduler, flow watcher and client warm-up, once.
+
+    Threads do not survive a fork, so under `gunicorn --preload` this has
+    to run in each worker (gunicorn.conf.py calls it from post_fork);
+    otherwise the first request starts them.
+    """
+    global services_started
+    with services_lock:
+        if services_started:
+            return
+        started = time.perf_counter()
+        if CLIENT_WARMUP:
+            threading.Thread(target=warm_clients,
+                             name='client-warmup',
+                             daemon=True).start()
+        start_scheduler()
+        flow_watcher.start()
+        services_started = True
+        record_startup_phase('services', started)
+
+
+def ensure_background_services():
+    if not services_started:
+        start_background_services()
+
+
+def create_app():
+    """Build the Flask app around the already-loaded flows and lazy clients."""
+    started = time.perf_counter()
+    flask_app = Flask(__name__)
+    flask_app.config['SECRET_KEY'] = os.environ.get(
+        'SESSION_SECRET', 'dev-secret-key-change-in-production')
+    flask_app.register_blueprint(bp)
+    flask_app.before_request(ensure_background_services)
+    record_startup_phase('app', started)
+    return flask_app
+
+
+app = create_app()
+
+
+class AsgiApp:
+    """ASGI entry point: `uvicorn app:asgi_app`.
+
+    The event loop only accepts connections and reads bodies. POST /sms goes
+    straight to `handle_inbound_sms` on a pool of `max_in_flight` threads,
+    skipping Flask. Every other path is bridged to the Flask WSGI app on the
+    same pool. A single process can therefore hold hundreds of conversations
+    that are waiting on storage or Gemini, where a sync gunicorn worker
+    holds one.
+    """
+
+    SMS_HEADERS = [(b'content-type', b'text/html; charset=utf-8')]
+
+    def __init__(self, wsgi_app, max_in_flight):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(max_workers=max(max_in_flight, 1),
+                                           thread_name_prefix='asgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+
+        ensure_background_services()
+        body = await self._read_body(receive)
+        loop = asyncio.get_running_loop()
+        if scope['path'] == '/sms' and scope['method'] == 'POST':
+            status, headers, payload = await loop.run_in_executor(
+                self.executor, self._sms, scope, body)
+        else:
+            status, headers, payload = await loop.run_in_executor(
+                self.executor, self._wsgi, scope, body)
+
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': headers + [(b'content-length', str(len(payload)).encode())]
+        })
+        await send({'type': 'http.response.body', 'body': payload})
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                start_background_services()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                log_pipeline.drain(timeout=5)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    @staticmethod
+    async def _read_body(receive):
+        chunks = []
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                break
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+        return b''.join(chunks)
+
+    def _sms(self, scope, body):
+        if missing_vars:
+            payload = json.dumps({
+                "error": "Service Config Error",
+                "missing": missing_vars
+            }, separators=(',', ':'), sort_keys=True) + "\n"
+            return 500, [(b'content-type', b'application/json')], payload.encode()
+
+        # Same lookup order as Flask's request.values: query string first.
+        values = {}
+        for pairs in (scope.get('query_string', b''), body):
+            for key, value in parse_qsl(pairs.decode('utf-8'), keep_blank_values=True):
+                values.setdefault(key, value)
+        twiml = handle_inbound_sms(values.get('From', ''),
+                                   values.get('Body', '').strip())
+        return 200, self.SMS_HEADERS, twiml.encode('utf-8')
+
+    def _wsgi(self, scope, body):
+        server = scope.get('server') or ('localhost', 80)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', ''),
+            'PATH_INFO': scope['path'],
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+            'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+            'CONTENT_LENGTH': str(len(body))
+        }
+        for name, value in scope.get('headers', []):
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if name == 'CONTENT_TYPE':
+                environ['CONTENT_TYPE'] = value
+            elif name != 'CONTENT_LENGTH':
+                key = f"HTTP_{name}"
+                environ[key] = f"{environ[key]},{value}" if key in environ else value
+
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [(k.lower().encode('latin-1'), v.encode('latin-1'))
+                                   for k, v in headers if k.lower() != 'content-length']
+
+        result = self.wsgi_app(environ, start_response)
+        try:
+            payload = b''.join(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        return response['status'], response['headers'], payload
+
+
+asgi_app = AsgiApp(app, ASGI_MAX_IN_FLIGHT)
+record_startup_phase('boot', BOOT_STARTED)
+print("Startup: " + ", ".join(f"{k} {v}" for k, v in startup_timings.items()))
 
 if __name__ == '__main__':
+    if sys.argv[1:] == ['scheduler']:
+        print(f"=== Dedicated scheduler {scheduler_worker_id()} ===")
+        scheduler_worker()
+
+    if sys.argv[1:2] == ['rescore'] and len(sys.argv) == 3:
+        try:
+            print(json.dumps(rescore_survey(sys.argv[2])))
+        except KeyError:
+            print(f"Unknown survey '{sys.argv[2]}'")
+            sys.exit(1)
+        log_pipeline.drain()
+        sys.exit(0)
+
     print("=== mybrain@work SMS Service Starting ===")
     print(f"Twilio phone number: {TWILIO_PHONE_NUMBER}")
-    print(f"Database: Supabase")
+    storage = get_storage()
+    print(f"Database: {storage.name if storage else 'not connected'}")
     print(f"AI Model: Google Gemini 2.0 Flash")
     print("Features: Persistent Sessions, Scheduled Flows, Events Logging")
     if not missing_vars:
         print("All environment variables validated successfully")
 
+    start_background_services()
     app.run(host='0.0.0.0', port=8000, debug=False)
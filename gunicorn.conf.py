@@ -0,0 +1,20 @@
+"""Gunicorn settings, loaded automatically from the project root.
+
+With `--preload` the master imports app.py once, so every worker shares the
+parsed flows, trigger index and compiled flow graph copy-on-write. SDK
+clients are built lazily and background threads are started per worker in
+post_fork, since neither survives a fork.
+"""
+import gc
+
+
+def when_ready(server):
+    if server.cfg.preload_app:
+        # Keep the garbage collector from touching (and so copying) the
+        # pages the workers inherit from the master.
+        gc.freeze()
+
+
+def post_fork(server, worker):
+    import app
+    app.start_background_services()
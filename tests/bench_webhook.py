@@ -0,0 +1,507 @@
+#!/usr/bin/env python3
+"""
+Load and latency benchmark for the /sms webhook
+
+Replays scripted conversations (flow_router, ouch_flow, unblock_flow and the
+quiz hooks) across many simulated phones. Storage, Gemini and Twilio are
+replaced by local stand-ins with configurable latency, so runs are
+repeatable and need no credentials or network.
+
+    python tests/bench_webhook.py --phones 200 --concurrency 16
+    python tests/bench_webhook.py --storage-ms 40 --gemini-ms 800 --json run.json
+    python tests/bench_webhook.py --server --compare run.json
+
+Reports p50/p95/p99 latency, messages/sec and backend calls per message.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from xml.etree import ElementTree as ET
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORK_DIR = tempfile.mkdtemp(prefix='pulse-bench-')
+
+# The app reads its configuration at import time
+os.environ.update({
+    'STORAGE_BACKEND': 'sqlite',
+    'SQLITE_PATH': os.path.join(WORK_DIR, 'bench.sqlite3'),
+    'LLM_CACHE_PATH': os.path.join(WORK_DIR, 'llm_cache.sqlite3'),
+    'SCHEDULER_ENABLED': '0',
+    'FLOW_WATCH_INTERVAL': '0',
+    'CLIENT_WARMUP': '0',
+    'TWILIO_ACCOUNT_SID': 'ACbench',
+    'TWILIO_AUTH_TOKEN': 'bench',
+    'TWILIO_PHONE_NUMBER': '+15550000000',
+    'GEMINI_API_KEY': 'bench',
+})
+os.environ.setdefault('TWILIO_MAX_MPS', '1000')
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+# name -> list of (kind, payload); 'sms' posts a message body, 'typeform'
+# posts a quiz submission for the phone
+SCRIPTS = {
+    'router': [
+        ('sms', 'MENU'),
+        ('sms', 'PING'),
+        ('sms', 'MENU'),
+    ],
+    'ouch': [
+        ('sms', 'OUCH'),
+        ('sms', 'Boss'),
+        ('sms', 'He dismissed my plan in front of the whole team'),
+    ],
+    'unblock_friction': [
+        ('sms', 'UNBLOCK'),
+        ('sms', '2'),
+        ('sms', 'OK'),
+    ],
+    'unblock_fog': [
+        ('sms', 'STUCK'),
+        ('sms', '1'),
+        ('sms', 'Open the budget sheet'),
+    ],
+    'style_quiz': [
+        ('typeform', {'first_name': 'Sam', 'survey': 'style',
+                      'answers': {'q1': 0, 'q2': 1, 'q3': 0, 'q4': 1, 'q5': 0}}),
+        ('sms', 'YES'),
+        ('sms', 'MENU'),
+    ],
+    'burnout_quiz': [
+        ('typeform', {'first_name': 'Ria', 'survey': 'burnout',
+                      'answers': {'q1': 1, 'q2': 1, 'q3': 0}}),
+        ('sms', 'YES'),
+    ],
+}
+
+
+class CallCounter:
+    """Thread-safe tally of backend calls, keyed by 'service.method'."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = Counter()
+
+    def add(self, key):
+        with self._lock:
+            self.counts[key] += 1
+
+    def total(self, prefix):
+        with self._lock:
+            return sum(n for k, n in self.counts.items()
+                       if k.startswith(prefix + '.'))
+
+    def snapshot(self):
+        with self._lock:
+            return dict(sorted(self.counts.items()))
+
+
+calls = CallCounter()
+
+
+class SlowStorage:
+    """Wraps a real Storage backend, adding latency to every call.
+
+    Stands in for Supabase: each method is one round trip, so the sleep
+    models network latency while SQLite keeps the data honest.
+    """
+
+    def __init__(self, inner, latency):
+        self._inner = inner
+        self._latency = latency
+        self.name = f'bench({inner.name})'
+
+    # answered from memory after the backend's first check
+    LOCAL = frozenset(['supports_versions'])
+
+    def __getattr__(self, name):
+        attr = getattr(self._inner, name)
+        if not callable(attr) or name.startswith('_') or name in self.LOCAL:
+            return attr
+
+        def call(*args, **kwargs):
+            calls.add(f'storage.{name}')
+            if self._latency:
+                time.sleep(self._latency)
+            return attr(*args, **kwargs)
+
+        return call
+
+
+class FakeGeminiResponse:
+
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeGeminiModel:
+    """Answers the prompts the flows send, after a configurable delay."""
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def _answer(self, prompt):
+        if 'Analyze this user message' in prompt:
+            return FakeGeminiResponse(
+                '{"pattern": "Micromanagement", "category": "NORMAL"}')
+        return FakeGeminiResponse(
+            'Lead with your strength today and protect one hour of focus.')
+
+    def generate_content(self, prompt):
+        calls.add('gemini.generate_content')
+        time.sleep(self.latency)
+        return self._answer(prompt)
+
+    async def generate_content_async(self, prompt):
+        calls.add('gemini.generate_content_async')
+        await asyncio.sleep(self.latency)
+        return self._answer(prompt)
+
+    def count_tokens(self, text):
+        calls.add('gemini.count_tokens')
+        return len(text.split())
+
+
+class FakeTwilioMessages:
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def create(self, body, from_, to):
+        calls.add('twilio.messages.create')
+        time.sleep(self.latency)
+        sent_sms.add(to)
+
+
+class SentMessages:
+    """Phones that have been texted, so a script can wait for its SMS."""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._phones = Counter()
+
+    def add(self, phone):
+        with self._cond:
+            self._phones[phone] += 1
+            self._cond.notify_all()
+
+    def count(self, phone):
+        with self._cond:
+            return self._phones[phone]
+
+    def wait(self, phone, seen, timeout):
+        with self._cond:
+            return self._cond.wait_for(lambda: self._phones[phone] > seen,
+                                       timeout)
+
+
+sent_sms = SentMessages()
+
+
+class FakeTwilioClient:
+
+    def __init__(self, latency):
+        self.messages = FakeTwilioMessages(latency)
+
+
+def load_app(args):
+    """Import the app quietly and install the stand-ins."""
+    with contextlib.redirect_stdout(io.StringIO()), \
+            contextlib.redirect_stderr(io.StringIO()):
+        import app
+        storage = app.create_storage()
+
+    app.get_storage.set(SlowStorage(storage, args.storage_ms / 1000))
+    app.get_gemini_model.set(FakeGeminiModel(args.gemini_ms / 1000))
+    app.get_twilio.set(FakeTwilioClient(args.twilio_ms / 1000))
+    return app
+
+
+class TestClientTransport:
+    """Posts through Flask's test client, one client per thread."""
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self._local = threading.local()
+
+    def _client(self):
+        if not hasattr(self._local, 'client'):
+            self._local.client = self.flask_app.test_client()
+        return self._local.client
+
+    def sms(self, phone, body):
+        resp = self._client().post('/sms', data={'Body': body, 'From': phone})
+        return resp.status_code, resp.get_data(as_text=True)
+
+    def typeform(self, phone, payload):
+        resp = self._client().post('/hooks/typeform',
+                                   json={'phone': phone, **payload})
+        return resp.status_code, resp.get_data(as_text=True)
+
+    def close(self):
+        pass
+
+
+class ServerTransport:
+    """Runs the app on a local threaded WSGI server and posts over HTTP."""
+
+    def __init__(self, flask_app, concurrency):
+        import requests
+        from werkzeug.serving import WSGIRequestHandler, make_server
+
+        class QuietHandler(WSGIRequestHandler):
+
+            def log_request(self, *args, **kwargs):
+                pass
+
+        self.server = make_server('127.0.0.1', 0, flask_app, threaded=True,
+                                  request_handler=QuietHandler)
+        self.base_url = f'http://127.0.0.1:{self.server.server_port}'
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=concurrency)
+        self.session.mount('http://', adapter)
+
+    def sms(self, phone, body):
+        resp = self.session.post(f'{self.base_url}/sms',
+                                 data={'Body': body, 'From': phone})
+        return resp.status_code, resp.text
+
+    def typeform(self, phone, payload):
+        resp = self.session.post(f'{self.base_url}/hooks/typeform',
+                                 json={'phone': phone, **payload})
+        return resp.status_code, resp.text
+
+    def close(self):
+        self.server.shutdown()
+
+
+def reply_text(twiml):
+    try:
+        return '\n'.join(m.text or '' for m in ET.fromstring(twiml).iter('Message'))
+    except ET.ParseError:
+        return ''
+
+
+VERIFY_SMS_TIMEOUT = 30.0
+
+
+def run_conversation(transport, phone, script_name, results):
+    """Play one script for one phone; messages within it are sequential."""
+    for kind, payload in SCRIPTS[script_name]:
+        started = time.perf_counter()
+        if kind == 'typeform':
+            seen = sent_sms.count(phone)
+            status, body = transport.typeform(phone, payload)
+            ok = status == 202
+        else:
+            status, body = transport.sms(phone, payload)
+            ok = status == 200 and 'System Error' not in reply_text(body)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        results.append((script_name, kind, elapsed_ms, ok))
+        # quiz submissions are applied in the background; like a real user,
+        # reply only once the verification text has arrived
+        if kind == 'typeform' and ok:
+            sent_sms.wait(phone, seen, VERIFY_SMS_TIMEOUT)
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1,
+                max(0, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(samples):
+    values = sorted(ms for _, _, ms, _ in samples)
+    return {
+        'count': len(values),
+        'errors': sum(1 for *_, ok in samples if not ok),
+        'p50_ms': round(percentile(values, 50), 2),
+        'p95_ms': round(percentile(values, 95), 2),
+        'p99_ms': round(percentile(values, 99), 2),
+        'max_ms': round(values[-1], 2) if values else 0.0,
+    }
+
+
+def wait_for_background_work(app, timeout=30.0):
+    """Let outbound SMS and conversation logs finish before counting calls."""
+    end = time.monotonic() + timeout
+    while time.monotonic() < end and app.outbound.stats()['active_destinations']:
+        time.sleep(0.01)
+    app.submission_intake.drain(max(end - time.monotonic(), 0.1))
+    while time.monotonic() < end and app.outbound.stats()['active_destinations']:
+        time.sleep(0.01)
+    app.log_pipeline.drain(max(end - time.monotonic(), 0.1))
+
+
+def run_benchmark(args):
+    app = load_app(args)
+    if args.server:
+        transport = ServerTransport(app.app, args.concurrency)
+    else:
+        transport = TestClientTransport(app.app)
+
+    names = [n for n in args.scripts if n in SCRIPTS]
+    plan = [(f'+1555{i:07d}', names[i % len(names)]) for i in range(args.phones)]
+
+    log = io.StringIO()
+    results = []
+    try:
+        with contextlib.redirect_stdout(sys.stdout if args.verbose else log):
+            if args.warmup:
+                warm = []
+                for i, name in enumerate(names):
+                    run_conversation(transport, f'+1556{i:07d}', name, warm)
+                wait_for_background_work(app)
+            calls.counts.clear()
+
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+                futures = [
+                    pool.submit(run_conversation, transport, phone, name, results)
+                    for phone, name in plan
+                ]
+                for future in futures:
+                    future.result()
+            wall_seconds = time.perf_counter() - started
+            wait_for_background_work(app)
+    finally:
+        transport.close()
+
+    messages = len(results)
+    backend = calls.snapshot()
+    return {
+        'config': {
+            'transport': 'server' if args.server else 'test_client',
+            'phones': args.phones,
+            'concurrency': args.concurrency,
+            'scripts': names,
+            'storage_ms': args.storage_ms,
+            'gemini_ms': args.gemini_ms,
+            'twilio_ms': args.twilio_ms,
+            'storage_backend': app.get_storage().name,
+            'flows_version': app.db.current().version,
+        },
+        'messages': messages,
+        'wall_seconds': round(wall_seconds, 3),
+        'messages_per_second': round(messages / wall_seconds, 1) if wall_seconds else 0.0,
+        'latency': summarize(results),
+        'by_script': {
+            name: summarize([r for r in results if r[0] == name])
+            for name in names
+        },
+        'backend_calls': backend,
+        'calls_per_message': {
+            service: round(calls.total(service) / messages, 3) if messages else 0.0
+            for service in ('storage', 'gemini', 'twilio')
+        },
+        'app_stats': {
+            'llm': app.llm_executor.stats(),
+            'log_pipeline': app.log_pipeline.stats(),
+            'outbound': app.outbound.stats(),
+            'phone_locks': app.phone_locks.stats(),
+            'intake': app.submission_intake.stats(),
+        },
+    }
+
+
+def print_report(report, baseline=None):
+    def delta(path, value):
+        if not baseline:
+            return ''
+        ref = baseline
+        for key in path:
+            ref = ref.get(key, {}) if isinstance(ref, dict) else {}
+        if not isinstance(ref, (int, float)) or not ref:
+            return ''
+        return f'  ({(value - ref) / ref * 100:+.1f}% vs baseline {ref})'
+
+    cfg = report['config']
+    print("=" * 60)
+    print("Neuvero Pulse /sms benchmark")
+    print("=" * 60)
+    print(f"Transport: {cfg['transport']}, phones: {cfg['phones']}, "
+          f"concurrency: {cfg['concurrency']}")
+    print(f"Injected latency: storage {cfg['storage_ms']}ms, "
+          f"gemini {cfg['gemini_ms']}ms, twilio {cfg['twilio_ms']}ms")
+    print()
+    print(f"Messages:     {report['messages']} in {report['wall_seconds']}s")
+    print(f"Throughput:   {report['messages_per_second']} msg/s"
+          f"{delta(['messages_per_second'], report['messages_per_second'])}")
+    for key in ('p50_ms', 'p95_ms', 'p99_ms'):
+        value = report['latency'][key]
+        print(f"{key[:3]:<13} {value}ms{delta(['latency', key], value)}")
+    print(f"Errors:       {report['latency']['errors']}")
+    print()
+    print("Backend calls per message:")
+    for service, value in report['calls_per_message'].items():
+        print(f"  {service:<10} {value}{delta(['calls_per_message', service], value)}")
+    print()
+    print(f"{'script':<18} {'msgs':>6} {'p50':>9} {'p95':>9} {'p99':>9} {'errors':>7}")
+    for name, stats in report['by_script'].items():
+        print(f"{name:<18} {stats['count']:>6} {stats['p50_ms']:>9} "
+              f"{stats['p95_ms']:>9} {stats['p99_ms']:>9} {stats['errors']:>7}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--phones', type=int, default=100,
+                        help='simulated phones, each playing one script (default 100)')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='conversations in flight at once (default 8)')
+    parser.add_argument('--scripts', nargs='+', default=list(SCRIPTS),
+                        choices=list(SCRIPTS), help='scripts to replay (default all)')
+    parser.add_argument('--storage-ms', type=float, default=20.0,
+                        help='latency added to every storage call (default 20)')
+    parser.add_argument('--gemini-ms', type=float, default=300.0,
+                        help='latency of each Gemini call (default 300)')
+    parser.add_argument('--twilio-ms', type=float, default=50.0,
+                        help='latency of each outbound SMS (default 50)')
+    parser.add_argument('--server', action='store_true',
+                        help='serve the app on a local port and post over HTTP')
+    parser.add_argument('--no-warmup', dest='warmup', action='store_false',
+                        help='skip the warm-up pass over each script')
+    parser.add_argument('--json', metavar='PATH',
+                        help="write the report as JSON ('-' for stdout)")
+    parser.add_argument('--compare', metavar='PATH',
+                        help='show changes against an earlier --json report')
+    parser.add_argument('--verbose', action='store_true',
+                        help='show the app log while running')
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    report = run_benchmark(args)
+
+    if args.json == '-':
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report, baseline)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(report, f, indent=2)
+            print(f"\nReport written to {args.json}")
+
+    if report['latency']['errors']:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Tests for the queued Typeform intake (SubmissionIntake)
+
+Runs against a throwaway SQLite database with Twilio, Gemini and the
+scheduler disabled:
+
+    python -m pytest tests/test_intake.py
+"""
+
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORK_DIR = tempfile.mkdtemp(prefix='pulse-intake-')
+
+# The app reads its configuration at import time
+os.environ.update({
+    'STORAGE_BACKEND': 'sqlite',
+    'SQLITE_PATH': os.path.join(WORK_DIR, 'intake.sqlite3'),
+    'LLM_CACHE_PATH': os.path.join(WORK_DIR, 'llm_cache.sqlite3'),
+    'SCHEDULER_ENABLED': '0',
+    'FLOW_WATCH_INTERVAL': '0',
+    'CLIENT_WARMUP': '0',
+})
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+import app  # noqa: E402
+
+
+class FailingStorage:
+    """Delegates to the real backend but fails every user write and read."""
+
+    FAILING = {'assign_users', 'get_user', 'create_user'}
+
+    def __init__(self, inner):
+        self.inner = inner
+
+    def __getattr__(self, name):
+        if name in self.FAILING:
+            def fail(*args, **kwargs):
+                raise RuntimeError(f"{name} unavailable")
+            return fail
+        return getattr(self.inner, name)
+
+
+def make_submission(phone):
+    return {
+        'phone': phone,
+        'first_name': 'Sam',
+        'profile': 'Strategist',
+        'survey': 'style',
+        'answers': {'q1': 0, 'q2': 1},
+        'result': None
+    }
+
+
+def test_resubmission_after_failed_apply_is_accepted():
+    storage = app.get_storage()
+    intake = app.SubmissionIntake(batch_size=10, workers=1)
+    phone = '+15550001001'
+    try:
+        app.get_storage.set(FailingStorage(storage))
+        assert intake.submit(make_submission(phone)) == 'accepted'
+        assert intake.drain()
+        assert intake.stats()['failed'] == 1
+
+        app.get_storage.set(storage)
+        assert intake.submit(make_submission(phone)) == 'accepted'
+        assert intake.drain()
+        assert storage.get_user(phone)['current_flow'] == \
+            app.SubmissionIntake.VERIFY_FLOW
+    finally:
+        app.get_storage.set(storage)
+        intake.shutdown()
+
+
+def test_repeat_of_applied_submission_is_duplicate():
+    intake = app.SubmissionIntake(batch_size=10, workers=1)
+    phone = '+15550001002'
+    try:
+        assert intake.submit(make_submission(phone)) == 'accepted'
+        assert intake.drain()
+        assert intake.submit(make_submission(phone)) == 'duplicate'
+    finally:
+        intake.shutdown()